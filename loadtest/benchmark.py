@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import platform
+import tempfile
+import subprocess
+from kerground import Kerground
+
+# Benchmarks for the enqueue, dispatch and status paths, run it with:
+#   python benchmark.py --backends file sqlite --workers 1 2 4 --output results.json
+# Every number is saved as one json record so runs can be compared.
+
+
+def process_noop(sent: float):
+    return time.time() - sent
+
+
+def thread_noop(sent: float):
+    return time.time() - sent
+
+
+def sync_noop(sent: float):
+    return time.time() - sent
+
+
+async def async_noop(sent: float):
+    return time.time() - sent
+
+
+MODES = {
+    "process": process_noop,
+    "thread": thread_noop,
+    "sync": sync_noop,
+    "async": async_noop,
+}
+
+
+def make_ker(tasks_path: str, backend: str):
+    ker = Kerground(tasks_path=tasks_path, backend=backend, log_level="WARNING")
+    ker.register(ker.MODE.PROCESS)(process_noop)
+    ker.register(ker.MODE.THREAD)(thread_noop)
+    ker.register(ker.MODE.SYNC)(sync_noop)
+    ker.register(async_noop)
+    return ker
+
+
+def log(*args):
+    print(*args, file=sys.stderr, flush=True)
+
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def start_workers(tasks_path: str, backend: str, workers: int):
+    env = dict(os.environ, BENCH_TASKS_PATH=tasks_path, BENCH_BACKEND=backend)
+    procs = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker"], env=env)
+        for _ in range(workers)
+    ]
+    # Listening once each of them has its wakeup socket
+    wakeup_path = os.path.join(tasks_path, "wakeup")
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if os.path.isdir(wakeup_path) and len(os.listdir(wakeup_path)) >= workers:
+            break
+        time.sleep(0.05)
+    return procs
+
+
+def stop_workers(procs: list):
+    for proc in procs:
+        proc.send_signal(signal.SIGINT)
+    for proc in procs:
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def enqueue_backlog(ker: Kerground, fn, jobs: int):
+    ids = []
+    for start in range(0, jobs, 1000):
+        ids += ker.enqueue_many(fn, [time.time()] * min(1000, jobs - start))
+    return ids
+
+
+def drain_rate(ker: Kerground, task: str, jobs: int, timeout: float):
+    # Timed from the first finished job so the workers startup doesn't count
+    first, deadline = None, time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        counts = {t["task"]: t for t in ker.get_current_tasks()}[task]
+        finished = counts["done"] + counts["failed"]
+        if first is None and finished:
+            first = (time.perf_counter(), finished)
+        if finished >= jobs:
+            if finished == first[1]:
+                return None
+            return (finished - first[1]) / (time.perf_counter() - first[0])
+        time.sleep(0.01)
+    return None
+
+
+def bench_enqueue(ker: Kerground, jobs: int):
+    start = time.perf_counter()
+    for _ in range(jobs):
+        ker.enqueue(thread_noop, time.time())
+    one_by_one = jobs / (time.perf_counter() - start)
+    start = time.perf_counter()
+    enqueue_backlog(ker, thread_noop, jobs)
+    many = jobs / (time.perf_counter() - start)
+    return {"enqueue_per_second": one_by_one, "enqueue_many_per_second": many}
+
+
+def bench_status(ker: Kerground, sizes: list):
+    # The cost of the status lookups as the queue grows, the jobs are pending
+    records, ids = [], []
+    for size in sizes:
+        ids += enqueue_backlog(ker, sync_noop, size - len(ids))
+        sample = random.sample(ids, min(1000, len(ids)))
+        start = time.perf_counter()
+        for message_id in sample:
+            ker.check_status(message_id)
+        check_status = (time.perf_counter() - start) / len(sample)
+        start = time.perf_counter()
+        ker.check_statuses(sample)
+        check_statuses = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(100):
+            ker.get_current_tasks()
+        get_current_tasks = (time.perf_counter() - start) / 100
+        records.append(
+            {
+                "queued": size,
+                "check_status_us": check_status * 1e6,
+                "check_statuses_1000_ms": check_statuses * 1e3,
+                "get_current_tasks_us": get_current_tasks * 1e6,
+            }
+        )
+    return records
+
+
+def bench_throughput(ker, tasks_path, backend, mode, workers, jobs, timeout):
+    # A backlog of jobs drained by the workers, None if it took over the timeout
+    fn = MODES[mode]
+    enqueue_backlog(ker, fn, jobs)
+    procs = start_workers(tasks_path, backend, workers)
+    try:
+        return {"jobs_per_second": drain_rate(ker, fn.__name__, jobs, timeout)}
+    finally:
+        stop_workers(procs)
+
+
+def bench_latency(ker, tasks_path, backend, mode, workers, jobs, timeout):
+    # Jobs enqueued one at a time to idle workers, from enqueue to start
+    fn = MODES[mode]
+    procs = start_workers(tasks_path, backend, workers)
+    try:
+        ids = []
+        for _ in range(jobs):
+            ids.append(ker.enqueue(fn, time.time()))
+            time.sleep(0.005)
+        latencies = [ker.get_result(i, timeout=timeout) * 1e3 for i in ids]
+    finally:
+        stop_workers(procs)
+    return {
+        "p50_ms": percentile(latencies, 50),
+        "p90_ms": percentile(latencies, 90),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies),
+    }
+
+
+def run(args):
+    records = []
+
+    def record(benchmark, backend, values, **labels):
+        records.append({"benchmark": benchmark, "backend": backend, **labels, **values})
+        log(json.dumps(records[-1]))
+
+    for backend in args.backends:
+        with tempfile.TemporaryDirectory(dir=args.tmp) as tasks_path:
+            ker = make_ker(tasks_path, backend)
+            record("enqueue", backend, bench_enqueue(ker, args.jobs), jobs=args.jobs)
+        with tempfile.TemporaryDirectory(dir=args.tmp) as tasks_path:
+            ker = make_ker(tasks_path, backend)
+            for values in bench_status(ker, args.sizes):
+                record("status", backend, values)
+        for mode in args.modes:
+            for workers in args.workers:
+                with tempfile.TemporaryDirectory(dir=args.tmp) as tasks_path:
+                    ker = make_ker(tasks_path, backend)
+                    values = bench_throughput(
+                        ker, tasks_path, backend, mode, workers, args.jobs, args.timeout
+                    )
+                    record(
+                        "throughput",
+                        backend,
+                        values,
+                        mode=mode,
+                        workers=workers,
+                        jobs=args.jobs,
+                    )
+                with tempfile.TemporaryDirectory(dir=args.tmp) as tasks_path:
+                    ker = make_ker(tasks_path, backend)
+                    values = bench_latency(
+                        ker,
+                        tasks_path,
+                        backend,
+                        mode,
+                        workers,
+                        args.samples,
+                        args.timeout,
+                    )
+                    record(
+                        "latency",
+                        backend,
+                        values,
+                        mode=mode,
+                        workers=workers,
+                        jobs=args.samples,
+                    )
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "started": args.started,
+        "results": records,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kerground benchmarks")
+    parser.add_argument("--backends", nargs="+", default=["file", "sqlite"])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument(
+        "--workers", nargs="+", type=int, default=[1, 2, os.cpu_count()]
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=5000, help="jobs per throughput run"
+    )
+    parser.add_argument("--samples", type=int, default=200, help="jobs per latency run")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--tmp", default=None, help="where the tasks_path are created")
+    parser.add_argument("--output", default=None, help="json file, stdout by default")
+    args = parser.parse_args()
+    args.workers = sorted(set(args.workers))
+    args.started = time.time()
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as jsonfile:
+            json.dump(results, jsonfile, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["worker"]:
+        make_ker(os.environ["BENCH_TASKS_PATH"], os.environ["BENCH_BACKEND"]).listen()
+    else:
+        main()
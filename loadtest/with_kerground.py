@@ -9,6 +9,5 @@ if __name__ == "__main__":
 
     print("Started with kerground...")
     startker = time.perf_counter()
-    for _ in range(tasks):
-        ker.enqueue("convert_files", ['filepaths'])
+    ker.enqueue_many("convert_files", [['filepaths']] * tasks)
     ker.listen()
\ No newline at end of file
@@ -1,16 +1,48 @@
 import os
 import time
 import uuid
+import gzip
+import heapq
 import json
-import shutil
+import mmap
+import hashlib
+import sqlite3
+import select
+import signal
+import socket
+import struct
+import asyncio
+import copy
+import random
+import logging
+import logging.handlers
+import inspect
+import importlib
 import itertools
 import traceback
 from enum import Enum
+from datetime import datetime, timedelta
 from functools import wraps
-from threading import Thread
-from itertools import groupby
-from operator import itemgetter
-from multiprocessing import Process, cpu_count
+from contextlib import contextmanager
+from threading import Thread, Lock, Event, local
+from multiprocessing import get_context, cpu_count
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 def batch(iterable, size):
@@ -19,7 +51,227 @@ def batch(iterable, size):
         yield item
 
 
+def parse_cron(expression: str):
+    # minute, hour, day of month, month and day of week like in crontab
+    fields = expression.split()
+    assert len(fields) == 5, "schedule needs 5 fields like '*/5 * * * *'"
+    parsed = []
+    for field, (low, high) in zip(fields, [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]):
+        values = set()
+        try:
+            for part in field.split(","):
+                part, _, step = part.partition("/")
+                if part == "*":
+                    start, end = low, high
+                elif "-" in part:
+                    start, end = map(int, part.split("-"))
+                else:
+                    start = int(part)
+                    end = high if step else start
+                step = int(step or 1)
+                if step < 1 or start > end:
+                    raise ValueError(part)
+                values.update(range(start, end + 1, step))
+        except ValueError:
+            # Not a number, a step below 1 or a range backwards
+            values = set()
+        assert (
+            values and low <= min(values) and max(values) <= high
+        ), f"invalid schedule field '{field}'"
+        parsed.append(values)
+    # Sunday is both 0 and 7
+    parsed[4] = {day % 7 for day in parsed[4]}
+    # When both days are restricted a day matching any of them runs
+    either = not fields[2].startswith("*") and not fields[4].startswith("*")
+    return (*parsed, either)
+
+
+def cron_next(schedule: tuple, after: float):
+    minutes, hours, days, months, weekdays, either = schedule
+    t = datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+    t += timedelta(minutes=1)
+    limit = t + timedelta(days=366 * 5)
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            continue
+        day, weekday = t.day in days, t.isoweekday() % 7 in weekdays
+        if not ((day or weekday) if either else (day and weekday)):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+        if t.hour not in hours:
+            t = t.replace(minute=0) + timedelta(hours=1)
+            continue
+        if t.minute not in minutes:
+            t += timedelta(minutes=1)
+            continue
+        return t.timestamp()
+    raise ValueError("this schedule never runs")
+
+
+def parse_rate(rate_limit: str):
+    # Like "100/m", how many jobs per second, minute, hour or day
+    count, _, unit = rate_limit.partition("/")
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    assert (
+        count.isdigit() and int(count) >= 1 and unit in units
+    ), "rate_limit must look like '10/s', '100/m', '1000/h' or '10000/d'"
+    return int(count), units[unit]
+
+
 CPUS = cpu_count()
+HOSTNAME = socket.gethostname()
+
+
+def pid_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def claimer():
+    # Suffix of the files this process renames to claim them, with the host
+    # so workers sharing tasks_path from several hosts only check their own
+    return f"{HOSTNAME}-{os.getpid()}"
+
+
+def abandoned(f: str, ext: str):
+    # The name of the file claimed as `f` if its process on this host is gone
+    name, sep, owner = f.partition(f"{ext}.")
+    host, _, pid = owner.rpartition("-")
+    if sep and host == HOSTNAME and pid.isdigit() and not pid_alive(int(pid)):
+        return name + ext
+    return None
+
+
+logger = logging.getLogger("kerground")
+
+
+class LogFormatter(logging.Formatter):
+    # The fields given in `extra` go after the message like task=... or, with
+    # `json`, each event is one json object per line
+    FIELDS = ["task", "message_id", "attempt", "duration", "delay", "status"]
+
+    def __init__(self, json: bool = False):
+        super().__init__("%(asctime)s %(levelname)s [%(processName)s] %(message)s")
+        self.json = json
+
+    def fields(self, record: logging.LogRecord):
+        return {f: getattr(record, f) for f in self.FIELDS if hasattr(record, f)}
+
+    def formatMessage(self, record: logging.LogRecord):
+        fields = " ".join(f"{k}={v}" for k, v in self.fields(record).items())
+        message = super().formatMessage(record)
+        return f"{message} {fields}" if fields else message
+
+    def format(self, record: logging.LogRecord):
+        if not self.json:
+            return super().format(record)
+        event = {
+            "time": record.created,
+            "level": record.levelname,
+            "process": record.processName,
+            "message": record.getMessage(),
+            **self.fields(record),
+        }
+        if record.exc_info:
+            event["traceback"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            event["traceback"] = record.exc_text
+        return json.dumps(event, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # The traceback is sent apart from the message, the formatter of the
+    # worker places it
+    def prepare(self, record: logging.LogRecord):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Handlers writing the events of the worker, held while forking so no
+# process of the pool starts with a stream locked half way through a write
+_log_handlers = []
+
+
+def _acquire_log_handlers():
+    for handler in _log_handlers:
+        handler.acquire()
+
+
+def _release_log_handlers():
+    for handler in reversed(_log_handlers):
+        handler.release()
+
+
+@contextmanager
+def flocked(fd: int, shared: bool = False):
+    # Unlocked explicitly rather than on close, a process of the pool forked
+    # meanwhile shares the fd and would keep the lock for as long as it lives
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextmanager
+def locked_path(path: str, create: bool = True):
+    # Gives the fd of the file locked, opened again if it was removed while
+    # waiting for the lock so changes never go to a file no longer there
+    while True:
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0))
+        try:
+            with flocked(fd):
+                try:
+                    current = os.fstat(fd).st_ino == os.stat(path).st_ino
+                except FileNotFoundError:
+                    current = False
+                if current:
+                    yield fd
+                    return
+        finally:
+            os.close(fd)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        before=_acquire_log_handlers, after_in_parent=_release_log_handlers
+    )
+
+
+# Kerground instance inherited by the worker processes of the pool
+_worker = None
+
+
+def _init_process(ker, log_queue=None):
+    global _worker
+    _worker = ker
+    # Ctrl+C is handled by the parent which closes the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if log_queue is not None and not logger.handlers:
+        # Spawned, the handlers of the worker are not inherited
+        logger.setLevel(ker.log_level)
+        logger.handlers = [LogQueueHandler(log_queue)]
+        logger.propagate = False
+
+
+def _run_in_process(job):
+    # The result is saved by the child, only how it went is sent back
+    return _worker.run_job(job)
+
 
 DASHBOARD_TEMPLATE = """<!doctype html>
 <html lang="en">
@@ -64,6 +316,7 @@ DASHBOARD_TEMPLATE = """<!doctype html>
       <thead>
         <tr>
           <th>Task</th>
+          <th>Scheduled</th>
           <th>Pending</th>
           <th>Running</th>
           <th>Failed</th>
@@ -77,6 +330,7 @@ DASHBOARD_TEMPLATE = """<!doctype html>
 
         <tr>
           <td>{{ i['task'] }}</td>
+          <td>{{ i['scheduled'] }}</td>
           <td>{{ i['pending'] }}</td>
           <td>{{ i['running'] }}</td>
           <td>{{ i['failed'] }}</td>
@@ -105,46 +359,1900 @@ class Modes(str, Enum):
     PROCESS = "process"
     THREAD = "thread"
     SYNC = "sync"
+    ASYNC = "async"
 
 
 class Status(str, Enum):
+    SCHEDULED = "scheduled"
     PENDING = "pending"
     RUNNING = "running"
     FAILED = "failed"
     DONE = "done"
+    WAITING = "waiting"
+    UNKNOWN = "unknown"
+
+
+class TaskError(Exception):
+    pass
+
+
+class Limited(Exception):
+    # Raised by Backend.claim when the task is over its limits, `wait` is
+    # how long until it isn't or None until one of its jobs finishes
+    def __init__(self, wait: float = None):
+        super().__init__(wait)
+        self.wait = wait
+
+
+JOB_STATUSES = ["scheduled", "pending", "running", "failed", "done"]
+LEASE_EXPIRED = "Lease expired, the worker running this job stopped sending heartbeats"
+# How many jobs of a task are in each status, one signed 64 bit int each
+COUNTERS = struct.Struct(f"<{len(JOB_STATUSES)}q")
+# Archive segments bigger than this are not appended to anymore
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Upper bounds in seconds of the wait and run time histograms buckets
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+# Seconds between the saves of the metrics of a worker
+METRICS_EVERY = 5
+
+
+class Metrics:
+    # Counters and histograms by task of one worker, saved under tasks_path
+    # so the ones of all the workers can be added up
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name: str, task: str, value: int = 1):
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[task] = counter.get(task, 0) + value
+
+    def observe(self, name: str, task: str, seconds: float):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {}).get(task)
+            if histogram is None:
+                histogram = {"buckets": [0] * (len(BUCKETS) + 1), "sum": 0, "count": 0}
+                self.histograms[name][task] = histogram
+            position = next(
+                (i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS)
+            )
+            histogram["buckets"][position] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(
+                json.dumps({"counters": self.counters, "histograms": self.histograms})
+            )
 
 
-class Kerground:
+def merge_metrics(total: dict, snapshot: dict):
+    for name, tasks in snapshot.get("counters", {}).items():
+        counter = total.setdefault("counters", {}).setdefault(name, {})
+        for task, value in tasks.items():
+            counter[task] = counter.get(task, 0) + value
+    for name, tasks in snapshot.get("histograms", {}).items():
+        histograms = total.setdefault("histograms", {}).setdefault(name, {})
+        for task, histogram in tasks.items():
+            if task not in histograms:
+                histograms[task] = json.loads(json.dumps(histogram))
+                continue
+            merged = histograms[task]
+            merged["buckets"] = [
+                a + b for a, b in zip(merged["buckets"], histogram["buckets"])
+            ]
+            merged["sum"] += histogram["sum"]
+            merged["count"] += histogram["count"]
+    return total
+
+
+def render_prometheus(metrics: dict):
+    # Prometheus text format, https://prometheus.io/docs/instrumenting/exposition_formats/
+    lines = ["# TYPE kerground_jobs gauge"]
+    for task in metrics["tasks"]:
+        for status in JOB_STATUSES:
+            lines.append(
+                f'kerground_jobs{{task="{task["task"]}",status="{status}"}} {task[status]}'
+            )
+    for name, tasks in sorted(metrics["counters"].items()):
+        lines.append(f"# TYPE kerground_jobs_{name}_total counter")
+        for task, value in sorted(tasks.items()):
+            lines.append(f'kerground_jobs_{name}_total{{task="{task}"}} {value}')
+    for name, tasks in sorted(metrics["histograms"].items()):
+        lines.append(f"# TYPE kerground_job_{name}_seconds histogram")
+        for task, histogram in sorted(tasks.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ["+Inf"], histogram["buckets"]):
+                cumulative += count
+                lines.append(
+                    f'kerground_job_{name}_seconds_bucket{{task="{task}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f'kerground_job_{name}_seconds_sum{{task="{task}"}} {histogram["sum"]}'
+            )
+            lines.append(
+                f'kerground_job_{name}_seconds_count{{task="{task}"}} {histogram["count"]}'
+            )
+    lines.append("# TYPE kerground_workers gauge")
+    lines.append(f"kerground_workers {len(metrics['workers'])}")
+    # Each family after its own TYPE line, not interleaved
+    for name, field in [("slots", "size"), ("slots_busy", "busy")]:
+        lines.append(f"# TYPE kerground_worker_{name} gauge")
+        for worker, slots in sorted(metrics["workers"].items()):
+            for slot, usage in sorted(slots.items()):
+                labels = f'worker="{worker}",slot="{slot}"'
+                lines.append(f"kerground_worker_{name}{{{labels}}} {usage[field]}")
+    return "\n".join(lines) + "\n"
 
-    MODE = Modes
-    STATUS = Status
 
-    def __init__(self, tasks_path: str = "./.kergroundtasks", pool: int = 1):
-        self.tasks = {}
-        self.pool = pool
+class Serializer:
+    # How jobs are saved by the backends and sent to the workers, json by
+    # default. `dumps` gives str or bytes, `loads` takes either
+
+    def dumps(self, message):
+        return json.dumps(message)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def encode(self, message):
+        data = self.dumps(message)
+        return data.encode() if isinstance(data, str) else data
+
+    def dumps_many(self, messages: list):
+        return "\n".join(self.dumps(message) for message in messages)
+
+    def loads_many(self, stream):
+        # Each job along with how it was saved, written as it is when unpacked.
+        # Read from the open file a job at a time, not all at once
+        for line in stream:
+            line = line.rstrip(b"\n")
+            if line:
+                yield self.loads(line), line
+
+
+class OrjsonSerializer(Serializer):
+    # Same json as the default one, several times faster
+    def __init__(self):
+        assert orjson is not None, "orjson serializer needs `pip install orjson`"
+
+    def dumps(self, message):
+        return orjson.dumps(message)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps_many(self, messages: list):
+        return b"\n".join(orjson.dumps(message) for message in messages)
+
+
+class MsgpackSerializer(Serializer):
+    # Smaller and faster than json, can also send bytes to the tasks. Jobs
+    # saved as json before switching to it are still read
+    def __init__(self):
+        assert msgpack is not None, "msgpack serializer needs `pip install msgpack`"
+
+    def dumps(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def loads(self, data):
+        if isinstance(data, str) or data[:1] in (b"{", b"["):
+            return json.loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+    def dumps_many(self, messages: list):
+        return b"".join(self.dumps(message) for message in messages)
+
+    def loads_many(self, stream):
+        if stream.peek(1)[:1] == b"{":
+            yield from super().loads_many(stream)
+            return
+        # Only the bytes of the jobs not yielded yet are kept, `offset` is
+        # where they start in the file
+        unpacker = msgpack.Unpacker(raw=False)
+        data, offset, start = b"", 0, 0
+        for chunk in iter(lambda: stream.read(64 * 1024), b""):
+            unpacker.feed(chunk)
+            data, offset, start = data[start:] + chunk, offset + start, 0
+            for message in unpacker:
+                end = unpacker.tell() - offset
+                yield message, data[start:end]
+                start = end
+
+
+SERIALIZERS = {
+    "json": Serializer,
+    "orjson": OrjsonSerializer,
+    "msgpack": MsgpackSerializer,
+}
+
+
+BLOB_REFS = struct.Struct("<q")
+
+
+class BlobStore:
+    # Big bytes args are saved once under `tasks_path/blobs` by their sha256,
+    # each job using one holds a reference and the blob is removed once the
+    # last of them is finished. Tasks get a read only memoryview of the blob
+    # mapped in memory, shared by the processes instead of copied
+    MARKER = "kerground_blob"
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def spill(self, args: tuple, kwargs: dict, threshold: int):
+        if threshold is None:
+            return args, kwargs
+        args = tuple(self.spilled(value, threshold) for value in args)
+        kwargs = {key: self.spilled(value, threshold) for key, value in kwargs.items()}
+        return args, kwargs
+
+    def spilled(self, value, threshold: int):
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+        data = memoryview(value)
+        if data.nbytes < threshold:
+            return value
+        return {self.MARKER: self.put(data), "size": data.nbytes}
+
+    def is_ref(self, value):
+        return isinstance(value, dict) and self.MARKER in value
+
+    def digests(self, message: dict):
+        values = [*message["args"], *message["kwargs"].values()]
+        return [value[self.MARKER] for value in values if self.is_ref(value)]
+
+    def refs(self, digest: str, create: bool = True):
+        # The count of the jobs using a blob is changed with its file locked
+        return locked_path(os.path.join(self.path, f"{digest}.refs"), create)
+
+    def read_refs(self, fd: int):
+        data = os.pread(fd, BLOB_REFS.size, 0)
+        return BLOB_REFS.unpack(data)[0] if len(data) == BLOB_REFS.size else 0
+
+    def put(self, data: memoryview):
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.path, digest)
+        with self.refs(digest) as fd:
+            if not os.path.exists(path):
+                tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp, "wb") as blobfile:
+                    blobfile.write(data)
+                os.replace(tmp, path)
+            os.pwrite(fd, BLOB_REFS.pack(self.read_refs(fd) + 1), 0)
+        return digest
+
+    def release(self, digests: list):
+        for digest in digests:
+            try:
+                with self.refs(digest, create=False) as fd:
+                    refs = self.read_refs(fd) - 1
+                    if refs > 0:
+                        os.pwrite(fd, BLOB_REFS.pack(refs), 0)
+                        continue
+                    # The last job using it is finished
+                    os.remove(os.path.join(self.path, digest))
+                    os.remove(os.path.join(self.path, f"{digest}.refs"))
+            except FileNotFoundError:
+                pass
+
+    def load(self, args: list, kwargs: dict, mapped: list):
+        # References are replaced by their blobs, the mappings are added to
+        # `mapped` to be closed once the task is done
+        args = [self.loaded(value, mapped) for value in args]
+        kwargs = {key: self.loaded(value, mapped) for key, value in kwargs.items()}
+        return args, kwargs
+
+    def loaded(self, value, mapped: list):
+        if not self.is_ref(value):
+            return value
+        if not value["size"]:
+            # Empty files can't be mapped
+            return memoryview(b"")
+        with open(os.path.join(self.path, value[self.MARKER]), "rb") as blobfile:
+            mapping = mmap.mmap(blobfile.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        mapped.append((view, mapping))
+        return view
+
+    def close(self, mapped: list):
+        for view, mapping in mapped:
+            try:
+                view.release()
+                mapping.close()
+            except BufferError:
+                # The task kept a part of it, unmapped once that is collected
+                pass
+
+
+class Workflows:
+    # Jobs of a chain waiting for the ones before them are saved under
+    # `tasks_path/workflows` until all of those are finished, along with
+    # the list of jobs waiting for each job so its worker starts them
+    def __init__(self, path: str, serializer: Serializer):
+        self.path = path
+        self.serializer = serializer
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, path: str, data):
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, mode="wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def add(self, message: dict, after: list, gather: bool):
+        # `gather` passes the results of all the jobs before as a list
+        path = os.path.join(self.path, f"{message['message_id']}.json")
+        step = {"message": message, "after": after, "gather": gather}
+        self.write(path, self.serializer.dumps(step))
+
+    def link(self, message_id: str, dependents: list):
+        self.write(os.path.join(self.path, f"{message_id}.next"), "\n".join(dependents))
+
+    def dependents(self, message_id: str):
+        try:
+            with open(os.path.join(self.path, f"{message_id}.next"), "r") as f:
+                return f.read().split()
+        except FileNotFoundError:
+            return []
+
+    def unlink(self, message_id: str):
+        try:
+            os.remove(os.path.join(self.path, f"{message_id}.next"))
+        except FileNotFoundError:
+            pass
+
+    def load(self, message_id: str):
+        # None once it was started
+        try:
+            with open(os.path.join(self.path, f"{message_id}.json"), "rb") as f:
+                return self.serializer.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    def remove(self, message_id: str):
+        try:
+            os.remove(os.path.join(self.path, f"{message_id}.json"))
+        except FileNotFoundError:
+            pass
+
+    def is_waiting(self, message_id: str):
+        if not message_id or os.path.basename(message_id) != message_id:
+            return False
+        return os.path.exists(os.path.join(self.path, f"{message_id}.json"))
+
+    def waiting(self):
+        for f in os.listdir(self.path):
+            if f.endswith(".json"):
+                yield f[: -len(".json")]
+
+
+class ResultCache:
+    # Results of the tasks registered with `cache=True` by the hash of their
+    # args, one file each under `tasks_path/cache/<task>` so all the workers
+    # share them. A hit touches the file, the least recently used go first
+    def __init__(self, path: str):
+        self.path = path
+        self.puts = {}
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, args: list, kwargs: dict):
+        data = json.dumps([args, kwargs], sort_keys=True, default=repr)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, task: str, key: str, ttl: int = None):
+        # The result as saved, None if missing or older than the ttl
+        path = os.path.join(self.path, task, key)
+        try:
+            with open(path, "r") as cachefile:
+                created, data = cachefile.read().split("\n", 1)
+            if ttl is not None and time.time() - float(created) > ttl:
+                os.remove(path)
+                return None
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return data
+
+    def put(self, task: str, key: str, data: str, max_entries: int = None):
+        task_path = os.path.join(self.path, task)
+        os.makedirs(task_path, exist_ok=True)
+        path = os.path.join(task_path, key)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, mode="w") as cachefile:
+            cachefile.write(f"{time.time()}\n{data}")
+        os.replace(tmp, path)
+        if max_entries is None:
+            return
+        # Counted roughly, listed once every tenth of the limit put from here
+        self.puts[task] = self.puts.get(task, 0) + 1
+        if self.puts[task] >= max(1, max_entries // 10):
+            self.puts[task] = 0
+            self.evict(task_path, max_entries)
+
+    def evict(self, task_path: str, max_entries: int):
+        names = [f for f in os.listdir(task_path) if not f.endswith(".tmp")]
+        if len(names) <= max_entries:
+            return
+        used = []
+        for name in names:
+            try:
+                used.append((os.stat(os.path.join(task_path, name)).st_mtime, name))
+            except FileNotFoundError:
+                pass
+        # Down to a tenth under the limit so it isn't done on each put
+        used.sort()
+        for _, name in used[: len(used) - int(max_entries * 0.9)]:
+            try:
+                os.remove(os.path.join(task_path, name))
+            except FileNotFoundError:
+                pass
+
+    def purge(self, ttls: dict):
+        # Removes the results past the cache_ttl of their task
+        now = time.time()
+        for task, ttl in ttls.items():
+            try:
+                entries = os.scandir(os.path.join(self.path, task))
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.endswith(".tmp"):
+                        continue
+                    try:
+                        with open(entry.path, "r") as cachefile:
+                            created = float(cachefile.readline())
+                        if now - created > ttl:
+                            os.remove(entry.path)
+                    except (FileNotFoundError, ValueError):
+                        pass
+
+
+class Backend:
+    # Where jobs, their status and their results are saved, see FileBackend
+
+    serializer = Serializer()
+
+    def start(self):
+        pass
+
+    def put(self, message: dict):
+        raise NotImplementedError
+
+    def put_many(self, batch_id: str, messages: list):
+        for message in messages:
+            self.put(message)
+
+    def put_unique(self, message: dict):
+        raise NotImplementedError
+
+    def put_keyed(self, message: dict, key: str, keep):
+        # Saves the job unless the one saved with the same key is still kept,
+        # `keep(message_id, created)` tells, gives back the id of the job kept
+        raise NotImplementedError
+
+    def purge_keys(self, ttl: int, keep):
+        raise NotImplementedError
+
+    def status(self, message_id: str):
+        raise NotImplementedError
+
+    def statuses(self, message_ids: list):
+        return {message_id: self.status(message_id) for message_id in message_ids}
+
+    def iter_jobs(self, status: str, task: str = None):
+        raise NotImplementedError
+
+    def iter_pending(self, task: str):
+        # Along with a version of each job, claiming it with its version
+        # gives back the job read here as long as it wasn't saved again since
+        for message in self.iter_jobs("pending", task):
+            yield message, None
+
+    def jobs(self, status: str):
+        return list(self.iter_jobs(status))
+
+    def claim(
+        self,
+        task: str,
+        message_id: str,
+        worker_id: str,
+        lease: float,
+        limit: dict = None,
+        message: dict = None,
+        version=None,
+    ):
+        # The job as saved, a copy read earlier may be from before a retry,
+        # None when another worker claimed it first. The `message` from
+        # `iter_pending` is given back while it has the same `version`
+        raise NotImplementedError
+
+    def take(self, running: int, bucket: tuple, limit: dict):
+        # Called with the task locked, gives back the bucket with one token less
+        if limit["concurrency"] is not None and running >= limit["concurrency"]:
+            raise Limited()
+        if limit["rate"] is None:
+            return None
+        now = time.time()
+        count, per = limit["rate"]
+        tokens, updated = bucket or (count, now)
+        tokens = min(count, tokens + (now - updated) * count / per)
+        if tokens < 1:
+            raise Limited((1 - tokens) * per / count)
+        return tokens - 1, now
+
+    def move(self, task: str, message_id: str, old: str, new: str):
+        raise NotImplementedError
+
+    def schedule(self, message: dict, old: str):
+        raise NotImplementedError
+
+    def scheduled(self):
+        raise NotImplementedError
+
+    def next_due(self):
+        # When the first scheduled job is due, None if there is none
+        return min((due for due, _, _ in self.scheduled()), default=None)
+
+    def promote(self, task: str, message_id: str):
+        raise NotImplementedError
+
+    def heartbeat(self, jobs: list):
+        raise NotImplementedError
+
+    def reap(self, lease_for):
+        raise NotImplementedError
+
+    def recover(self):
+        # Tasks with jobs given back after the worker handling them was gone
+        return set()
+
+    def requeue(self, message: dict):
+        # A job whose lease expired counts as a failed attempt
+        retries = message.get("retries", 0)
+        if retries < message["max_retries"]:
+            message["retries"] = retries + 1
+            return Status.PENDING.value
+        return Status.FAILED.value
+
+    def save_result(self, message_id: str, status: str, data: str, error: str):
+        raise NotImplementedError
+
+    def load_result(self, message_id: str, ttl: int = None):
+        raise NotImplementedError
+
+    def purge_results(self, ttl: int):
+        raise NotImplementedError
+
+    def counts(self, tasks: list):
+        raise NotImplementedError
+
+    def compact(self, keep: dict, archive: bool, results: bool):
+        raise NotImplementedError
+
+    def expired(self, jobs: list, now: float, ttl: float, max_count: int):
+        # Newest first, the ones past the count or older than the ttl go
+        jobs.sort(key=lambda job: job[0], reverse=True)
+        if max_count is not None:
+            expired, jobs = jobs[max_count:], jobs[:max_count]
+        else:
+            expired = []
+        if ttl is not None:
+            expired += [job for job in jobs if now - job[0] > ttl]
+        return expired
+
+    def archive(self, jobs: list):
+        # Each call appends one gzip member to the segment of the task, a
+        # segment is only appended to by the process which started it
+        archive_path = os.path.join(self.tasks_path, "archive")
+        os.makedirs(archive_path, exist_ok=True)
+        lines = {}
+        for finished, status, message in jobs:
+            line = json.dumps(
+                {"status": status, "finished": finished, "job": message}, default=str
+            )
+            lines.setdefault(message["task"], []).append(line + "\n")
+        for task, task_lines in lines.items():
+            path = self.segments.get((os.getpid(), task))
+            if path is None or os.path.getsize(path) > SEGMENT_SIZE:
+                name = f"{task}--{time.time_ns()}-{HOSTNAME}-{os.getpid()}.jsonl.gz"
+                path = os.path.join(archive_path, name)
+                self.segments[(os.getpid(), task)] = path
+            with open(path, "ab") as segment:
+                segment.write(gzip.compress("".join(task_lines).encode()))
+                segment.flush()
+                os.fsync(segment.fileno())
+
+    def archived(self, task: str = None):
+        archive_path = os.path.join(self.tasks_path, "archive")
+        if not os.path.isdir(archive_path):
+            return
+        prefix = "" if task is None else f"{task}--"
+        for f in sorted(os.listdir(archive_path)):
+            if not f.startswith(prefix) or not f.endswith(".jsonl.gz"):
+                continue
+            with gzip.open(os.path.join(archive_path, f), "rt") as segment:
+                try:
+                    for line in segment:
+                        yield json.loads(line)
+                except EOFError:
+                    # The last member is still being appended
+                    pass
+
+
+class FileBackend(Backend):
+    def __init__(self, tasks_path: str):
         self.tasks_path = tasks_path
+        self.scheduled_path = os.path.join(tasks_path, "scheduled")
+        self.due, self.due_changed = None, None
         self.pending_path = os.path.join(tasks_path, "pending")
+        self.priorities_path = os.path.join(self.pending_path, "priority")
+        self.priority_paths = {0: self.pending_path}
         self.running_path = os.path.join(tasks_path, "running")
         self.done_path = os.path.join(tasks_path, "done")
         self.failed_path = os.path.join(tasks_path, "failed")
+        self.index_path = os.path.join(tasks_path, "index")
+        self.results_path = os.path.join(tasks_path, "results")
+        self.batches_path = os.path.join(tasks_path, "batches")
+        self.limits_path = os.path.join(tasks_path, "limits")
+        self.counts_path = os.path.join(tasks_path, "counts")
+        self.keys_path = os.path.join(tasks_path, "keys")
+        self.segments = {}
         self.all_paths = [
+            self.scheduled_path,
             self.pending_path,
             self.running_path,
             self.done_path,
             self.failed_path,
         ]
-        for path in self.all_paths:
+        for path in self.all_paths + [
+            self.priorities_path,
+            self.index_path,
+            self.results_path,
+            self.batches_path,
+            self.limits_path,
+            self.counts_path,
+            self.keys_path,
+        ]:
+            os.makedirs(path, exist_ok=True)
+
+    def start(self):
+        # Jobs saved before the index existed, even if some were indexed since
+        if not os.path.exists(os.path.join(self.index_path, ".rebuilt")):
+            self.rebuild_index()
+        # Jobs saved before the counters existed
+        if not os.path.exists(os.path.join(self.counts_path, ".rebuilt")):
+            self.rebuild_counts()
+        self.recover()
+        # Jobs left half reaped or half compacted by a worker which is gone,
+        # done again later
+        for jobs_path in [self.running_path, self.done_path, self.failed_path]:
+            for f in os.listdir(jobs_path):
+                name = abandoned(f, ".json")
+                if name is not None:
+                    path = os.path.join(jobs_path, f)
+                    os.replace(path, os.path.join(jobs_path, name))
+
+    def recover(self):
+        # Batches left half unpacked by a worker which is gone, unpacked again
+        # by the workers of their task
+        tasks = set()
+        for f in os.listdir(self.batches_path):
+            name = abandoned(f, ".jsonl")
+            if name is None:
+                continue
             try:
-                os.makedirs(path)
-            except:
+                path = os.path.join(self.batches_path, f)
+                os.rename(path, os.path.join(self.batches_path, name))
+            except FileNotFoundError:
+                # Recovered by another worker
+                continue
+            tasks.add(name.split("--", 1)[0])
+        return tasks
+
+    def job_path(self, status: str, task: str, message_id: str, priority: int = 0):
+        if status == Status.PENDING:
+            return os.path.join(
+                self.priority_path(priority), f"{task}--{message_id}.json"
+            )
+        return os.path.join(self.tasks_path, status, f"{task}--{message_id}.json")
+
+    def priority_path(self, priority: int):
+        # Pending jobs with a priority are kept in a folder for each, so the
+        # highest are read first without listing all the pending jobs
+        path = self.priority_paths.get(priority)
+        if path is None:
+            path = os.path.join(self.priorities_path, str(priority))
+            os.makedirs(path, exist_ok=True)
+            self.priority_paths[priority] = path
+        return path
+
+    def priorities(self):
+        # Highest first, 0 for the jobs without one, in pending itself
+        priorities = {0} | {int(p) for p in os.listdir(self.priorities_path)}
+        return sorted(priorities, reverse=True)
+
+    def status_paths(self, status: str):
+        if status == Status.PENDING:
+            return [self.priority_path(p) for p in self.priorities()]
+        return [os.path.join(self.tasks_path, status)]
+
+    def write(self, path: str, data: str, mtime: float = None):
+        # Written to a temporary file first so readers never see a partial file
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, mode="wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, path)
+
+    def index(self, task: str, message_id: str, status: str, worker_id: str = ""):
+        self.write(
+            os.path.join(self.index_path, message_id),
+            f"{task}\n{Status(status).value}\n{worker_id}",
+        )
+
+    def rebuild_index(self):
+        for status in JOB_STATUSES:
+            for path in self.status_paths(status):
+                for f in os.listdir(path):
+                    if f.endswith(".json"):
+                        task, message_id = f[: -len(".json")].split("--", 1)
+                        self.index(task, message_id, status)
+        self.write(os.path.join(self.index_path, ".rebuilt"), "")
+
+    def rebuild_counts(self):
+        counts = {}
+        for status in JOB_STATUSES:
+            for path in self.status_paths(status):
+                for f in os.listdir(path):
+                    if f.endswith(".json"):
+                        task = f.split("--", 1)[0]
+                        counts.setdefault(task, dict.fromkeys(JOB_STATUSES, 0))
+                        counts[task][status] += 1
+        for f in os.listdir(self.batches_path):
+            if f.endswith(".jsonl"):
+                task, _, size = f[: -len(".jsonl")].split("--")
+                counts.setdefault(task, dict.fromkeys(JOB_STATUSES, 0))
+                counts[task]["pending"] += int(size)
+        for task, values in counts.items():
+            self.count(task, values, absolute=True)
+        self.write(os.path.join(self.counts_path, ".rebuilt"), "")
+
+    def count(self, task: str, changes: dict, absolute: bool = False):
+        # The counters of a task are changed in place with the file locked,
+        # reading them costs the same however many jobs went through
+        fd = os.open(os.path.join(self.counts_path, task), os.O_RDWR | os.O_CREAT)
+        try:
+            with flocked(fd):
+                counts = self.read_counts(fd)
+                for status, n in changes.items():
+                    if absolute:
+                        counts[status] = n
+                    else:
+                        counts[status] += n
+                os.pwrite(fd, COUNTERS.pack(*counts.values()), 0)
+        finally:
+            os.close(fd)
+
+    def moved(self, task: str, old: str, new: str):
+        self.count(task, {Status(old).value: -1, Status(new).value: 1})
+
+    def read_counts(self, fd: int):
+        data = os.pread(fd, COUNTERS.size, 0)
+        if len(data) != COUNTERS.size:
+            return dict.fromkeys(JOB_STATUSES, 0)
+        return dict(zip(JOB_STATUSES, COUNTERS.unpack(data)))
+
+    def put(self, message: dict):
+        # The mtime of a scheduled job is when it is due
+        not_before = message.get("not_before")
+        status = Status.SCHEDULED if not_before else Status.PENDING
+        self.index(message["task"], message["message_id"], status)
+        path = self.job_path(
+            status.value,
+            message["task"],
+            message["message_id"],
+            message.get("priority", 0),
+        )
+        self.write(path, self.serializer.dumps(message), not_before)
+        self.count(message["task"], {status.value: 1})
+
+    def put_unique(self, message: dict):
+        # Linking fails if the index entry exists, only one of the workers
+        # adding the same job saves it
+        path = os.path.join(self.index_path, message["message_id"])
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, mode="w") as f:
+            f.write(f"{message['task']}\n{Status.PENDING.value}\n")
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+        self.put(message)
+        return True
+
+    def put_keyed(self, message: dict, key: str, keep):
+        # One file for each key, named by its hash, checked and changed locked
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        with locked_path(os.path.join(self.keys_path, digest)) as fd:
+            saved = self.read_key(fd)
+            if saved is not None and keep(*saved):
+                return saved[0]
+            self.put(message)
+            data = f"{message['message_id']}\n{time.time()}".encode()
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, data, 0)
+        return message["message_id"]
+
+    def read_key(self, fd: int):
+        data = os.pread(fd, 4096, 0).decode()
+        if not data:
+            return None
+        message_id, created = data.split("\n")
+        return message_id, float(created)
+
+    def purge_keys(self, ttl: int, keep):
+        # Only the keys older than the ttl can be of jobs no longer kept
+        now = time.time()
+        with os.scandir(self.keys_path) as entries:
+            for entry in entries:
+                try:
+                    if now - entry.stat().st_mtime <= ttl:
+                        continue
+                    with locked_path(entry.path, create=False) as fd:
+                        saved = self.read_key(fd)
+                        if saved is None or not keep(*saved):
+                            os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def put_many(self, batch_id: str, messages: list):
+        # One index entry for the batch and one file holding all its jobs,
+        # the worker unpacks it into pending jobs. The entry has the size of
+        # the batch in place of a worker
+        task = messages[0]["task"]
+        self.index(task, batch_id, Status.PENDING, str(len(messages)))
+        name = f"{task}--{batch_id}--{len(messages)}.jsonl"
+        path = os.path.join(self.batches_path, name)
+        self.write(path, self.serializer.dumps_many(messages))
+        self.count(task, {"pending": len(messages)})
+
+    def unpack_batches(self, prefix: str = ""):
+        for f in os.listdir(self.batches_path):
+            if not f.startswith(prefix) or not f.endswith(".jsonl"):
+                continue
+            path = os.path.join(self.batches_path, f)
+            unpacking = f"{path}.{claimer()}"
+            try:
+                os.rename(path, unpacking)
+            except FileNotFoundError:
+                # Another worker is unpacking it
+                continue
+            with open(unpacking, "rb") as batchfile:
+                for message, raw in self.serializer.loads_many(batchfile):
+                    task, message_id = message["task"], message["message_id"]
+                    # Already claimed before a crash while unpacking
+                    if os.path.exists(os.path.join(self.index_path, message_id)):
+                        continue
+                    path = self.job_path(
+                        "pending", task, message_id, message.get("priority", 0)
+                    )
+                    self.write(path, raw)
+                    try:
+                        version = self.version(os.stat(path))
+                    except FileNotFoundError:
+                        # Claimed by another worker meanwhile
+                        continue
+                    # Pending from now on, no need to wait for the whole batch
+                    yield message, version
+            os.remove(unpacking)
+            # Its jobs not indexed yet are pending, those missing are compacted
+            task, batch_id, size = f[: -len(".jsonl")].split("--")
+            self.write(
+                os.path.join(self.index_path, batch_id), f"{task}\nunpacked\n{size}"
+            )
+
+    def status(self, message_id: str):
+        # Ids come from clients, never let them point outside of the index
+        if not message_id or os.path.basename(message_id) != message_id:
+            return Status.UNKNOWN.value
+        try:
+            with open(os.path.join(self.index_path, message_id), "r") as indexfile:
+                return indexfile.read().split("\n")[1]
+        except FileNotFoundError:
+            pass
+        except IndexError:
+            return Status.UNKNOWN.value
+        # Jobs enqueued in a batch are indexed by their batch until claimed
+        batch_id, _, position = message_id.rpartition(".")
+        if batch_id and position.isdigit():
+            try:
+                with open(os.path.join(self.index_path, batch_id), "r") as indexfile:
+                    task, status, size = indexfile.read().split("\n")[:3]
+            except (FileNotFoundError, ValueError):
+                task, status, size = None, Status.UNKNOWN.value, ""
+            if size.isdigit() and int(position) >= int(size):
+                # Past the end of the batch
+                task, status = None, Status.UNKNOWN.value
+            if status == Status.PENDING:
+                return status
+            # Unpacked, claimed right now or compacted
+            for status in [Status.PENDING.value, Status.RUNNING.value]:
+                for path in self.status_paths(status) if task else []:
+                    if os.path.exists(os.path.join(path, f"{task}--{message_id}.json")):
+                        return status
+        # Compacted jobs are known by their result while it is kept
+        result = self.load_result(message_id)
+        return Status.UNKNOWN.value if result is None else result["status"]
+
+    def iter_jobs(self, status: str, task: str = None):
+        for message, _ in self.versioned_jobs(status, task):
+            yield message
+
+    def iter_pending(self, task: str):
+        return self.versioned_jobs("pending", task)
+
+    def versioned_jobs(self, status: str, task: str = None):
+        assert status in JOB_STATUSES
+        # Jobs of other tasks are skipped by name, without reading them
+        prefix = "" if task is None else f"{task}--"
+        if status != "pending":
+            yield from self.scan(os.path.join(self.tasks_path, status), prefix)
+            return
+        # Highest priority first, batches along with the jobs without one
+        for priority in self.priorities():
+            if priority == 0:
+                yield from self.unpack_batches(prefix)
+            yield from self.scan(self.priority_path(priority), prefix)
+
+    def scan(self, path: str, prefix: str):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.name.startswith(prefix) or not entry.name.endswith(
+                    ".json"
+                ):
+                    continue
+                try:
+                    with open(entry.path, "rb") as jobfile:
+                        message = self.serializer.loads(jobfile.read())
+                        version = self.version(os.fstat(jobfile.fileno()))
+                except FileNotFoundError:
+                    # Claimed by another worker meanwhile
+                    continue
+                yield message, version
+
+    def version(self, stat: os.stat_result):
+        # A job is written again to a new file, with its own inode and mtime
+        return stat.st_ino, stat.st_mtime_ns
+
+    @contextmanager
+    def locked(self, task: str):
+        # Held by one worker process at a time, while it checks the limits
+        path = os.path.join(self.limits_path, f"{task}.lock")
+        with open(path, "a") as lockfile, flocked(lockfile.fileno()):
+            yield
+
+    def claim(
+        self,
+        task: str,
+        message_id: str,
+        worker_id: str,
+        lease: float,
+        limit: dict = None,
+        message: dict = None,
+        version=None,
+    ):
+        if limit is None:
+            return self.rename_claim(task, message_id, worker_id, message, version)
+        with self.locked(task):
+            # The jobs running are read from the counters of the task, the
+            # tokens left are kept in a file next to the lock
+            running = self.counts([task])["running"].get(task, 0)
+            path = os.path.join(self.limits_path, f"{task}.json")
+            try:
+                with open(path, "r") as jsonfile:
+                    bucket = json.load(jsonfile)
+            except FileNotFoundError:
+                bucket = None
+            bucket = self.take(running, bucket, limit)
+            claimed = self.rename_claim(task, message_id, worker_id, message, version)
+            if claimed and bucket is not None:
+                self.write(path, json.dumps(bucket))
+            return claimed
+
+    def rename_claim(
+        self,
+        task: str,
+        message_id: str,
+        worker_id: str,
+        message: dict = None,
+        version=None,
+    ):
+        # Rename is atomic, only one of the workers racing for the job wins it.
+        # The mtime of a running job is its last heartbeat, touched before the
+        # rename so the job is never seen running with an old one
+        priority = 0 if message is None else message.get("priority", 0)
+        src = self.job_path("pending", task, message_id, priority)
+        dst = self.job_path("running", task, message_id)
+        try:
+            stat = os.stat(src)
+            os.utime(src)
+            os.rename(src, dst)
+        except FileNotFoundError:
+            return None
+        self.index(task, message_id, Status.RUNNING, worker_id)
+        self.moved(task, Status.PENDING, Status.RUNNING)
+        # The file renamed is the one looked at, not a newer one put meanwhile
+        if (
+            version is not None
+            and version == self.version(stat)
+            and os.stat(dst).st_ino == stat.st_ino
+        ):
+            return message
+        with open(dst, "rb") as jobfile:
+            return self.serializer.loads(jobfile.read())
+
+    def move(self, task: str, message_id: str, old: str, new: str):
+        assert old in JOB_STATUSES
+        assert new in JOB_STATUSES
+        src = self.job_path(old, task, message_id)
+        dst = self.job_path(new, task, message_id)
+        try:
+            os.rename(src, dst)
+        except FileNotFoundError:
+            # Reaped after its lease expired
+            return False
+        if new in [Status.DONE, Status.FAILED]:
+            # Kept for as long as the retention says from now on
+            os.utime(dst)
+        self.index(task, message_id, new)
+        self.moved(task, old, new)
+        return True
+
+    def schedule(self, message: dict, old: str):
+        task, message_id = message["task"], message["message_id"]
+        src = self.job_path(old, task, message_id)
+        moving = f"{src}.{claimer()}"
+        try:
+            os.rename(src, moving)
+        except FileNotFoundError:
+            # Reaped after its lease expired
+            return False
+        # Its mtime is when it is due, set before it shows up in scheduled
+        self.write(moving, self.serializer.dumps(message), message["not_before"])
+        os.rename(moving, self.job_path("scheduled", task, message_id))
+        self.index(task, message_id, Status.SCHEDULED)
+        self.moved(task, old, Status.SCHEDULED)
+        return True
+
+    def scheduled(self):
+        with os.scandir(self.scheduled_path) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                task, message_id = entry.name[: -len(".json")].split("--", 1)
+                try:
+                    yield entry.stat().st_mtime, message_id, task
+                except FileNotFoundError:
+                    continue
+
+    def next_due(self):
+        # Read again only once jobs were added to or removed from scheduled
+        changed = os.stat(self.scheduled_path).st_mtime_ns
+        if changed != self.due_changed:
+            self.due = super().next_due()
+            self.due_changed = changed
+        return self.due
+
+    def promote(self, task: str, message_id: str):
+        src = self.job_path("scheduled", task, message_id)
+        try:
+            # Read first to know where it goes, only one of the workers racing
+            # to promote the job wins it
+            with open(src, "rb") as jobfile:
+                message = self.serializer.loads(jobfile.read())
+            priority = message.get("priority", 0)
+            os.rename(src, self.job_path("pending", task, message_id, priority))
+        except FileNotFoundError:
+            return None
+        self.index(task, message_id, Status.PENDING)
+        self.moved(task, Status.SCHEDULED, Status.PENDING)
+        return message
+
+    def heartbeat(self, jobs: list):
+        for task, message_id, _ in jobs:
+            try:
+                os.utime(self.job_path("running", task, message_id))
+            except FileNotFoundError:
                 pass
 
-    def register(self, *dargs, mode: Modes = Modes.PROCESS, max_retries: int = 0):
+    def reap(self, lease_for):
+        reaped = []
+        now = time.time()
+        with os.scandir(self.running_path) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                task, message_id = entry.name[: -len(".json")].split("--", 1)
+                reaping = f"{entry.path}.{claimer()}"
+                try:
+                    if now - entry.stat().st_mtime <= lease_for(task):
+                        continue
+                    # Only one of the workers racing to reap the job wins it
+                    os.rename(entry.path, reaping)
+                except FileNotFoundError:
+                    continue
+                with open(reaping, "rb") as jobfile:
+                    message = self.serializer.loads(jobfile.read())
+                status = self.requeue(message)
+                self.write(reaping, self.serializer.dumps(message))
+                if status == Status.FAILED:
+                    self.save_result(message_id, status, "null", LEASE_EXPIRED)
+                priority = message.get("priority", 0)
+                os.rename(reaping, self.job_path(status, task, message_id, priority))
+                self.index(task, message_id, status)
+                self.moved(task, Status.RUNNING, status)
+                reaped.append((task, message_id, status, message))
+        return reaped
+
+    def save_result(self, message_id: str, status: str, data: str, error: str):
+        path = os.path.join(self.results_path, f"{message_id}.json")
+        # The result is already serialized, only wrap it
+        self.write(
+            path,
+            f'{{"status": {json.dumps(status)}, "traceback": {json.dumps(error)}, "result": {data}}}',
+        )
+
+    def load_result(self, message_id: str, ttl: int = None):
+        path = os.path.join(self.results_path, f"{message_id}.json")
+        try:
+            if ttl and time.time() - os.path.getmtime(path) > ttl:
+                os.remove(path)
+                return None
+            with open(path, "r") as jsonfile:
+                return json.load(jsonfile)
+        except FileNotFoundError:
+            return None
+
+    def purge_results(self, ttl: int):
+        now = time.time()
+        with os.scandir(self.results_path) as entries:
+            for entry in entries:
+                try:
+                    if now - entry.stat().st_mtime > ttl:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def compact(self, keep: dict, archive: bool, results: bool):
+        now = time.time()
+        jobs = {task: [] for task in keep}
+        for status in [Status.DONE.value, Status.FAILED.value]:
+            with os.scandir(os.path.join(self.tasks_path, status)) as entries:
+                for entry in entries:
+                    task = entry.name.split("--", 1)[0]
+                    if task not in jobs or not entry.name.endswith(".json"):
+                        continue
+                    try:
+                        jobs[task].append((entry.stat().st_mtime, status, entry.path))
+                    except FileNotFoundError:
+                        continue
+        compacted = 0
+        for task, (ttl, max_count) in keep.items():
+            expired = self.expired(jobs[task], now, ttl, max_count)
+            for expired_batch in batch(expired, 1000):
+                claimed = []
+                for finished, status, path in expired_batch:
+                    compacting = f"{path}.{claimer()}"
+                    try:
+                        # Only one of the workers racing to compact the job wins it
+                        os.rename(path, compacting)
+                    except FileNotFoundError:
+                        continue
+                    message = None
+                    if archive:
+                        with open(compacting, "rb") as jobfile:
+                            message = self.serializer.loads(jobfile.read())
+                    claimed.append((finished, status, message, compacting))
+                if archive and claimed:
+                    self.archive([job[:3] for job in claimed])
+                for _, _, _, compacting in claimed:
+                    name = os.path.basename(compacting)
+                    message_id = name[len(f"{task}--") : -len(f".json.{claimer()}")]
+                    os.remove(compacting)
+                    paths = [os.path.join(self.index_path, message_id)]
+                    if results:
+                        paths.append(
+                            os.path.join(self.results_path, f"{message_id}.json")
+                        )
+                    for path in paths:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                compacted += len(claimed)
+        return compacted
+
+    def counts(self, tasks: list):
+        counts = {status: {} for status in JOB_STATUSES}
+        for task in tasks:
+            try:
+                fd = os.open(os.path.join(self.counts_path, task), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                with flocked(fd, shared=True):
+                    for status, count in self.read_counts(fd).items():
+                        counts[status][task] = count
+            finally:
+                os.close(fd)
+        return counts
+
+
+class SQLiteBackend(Backend):
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        message_id TEXT PRIMARY KEY,
+        task TEXT NOT NULL,
+        status TEXT NOT NULL,
+        message TEXT NOT NULL,
+        created REAL NOT NULL,
+        updated REAL NOT NULL,
+        worker TEXT,
+        lease_until REAL,
+        not_before REAL,
+        rank INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS jobs_task_queue ON jobs (status, task, rank, created, message_id);
+    CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created, message_id);
+    CREATE INDEX IF NOT EXISTS jobs_status_not_before ON jobs (status, not_before);
+    CREATE INDEX IF NOT EXISTS jobs_task_status_updated ON jobs (task, status, updated);
+    CREATE TABLE IF NOT EXISTS results (
+        message_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        result TEXT,
+        traceback TEXT,
+        finished REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS results_finished ON results (finished);
+    CREATE TABLE IF NOT EXISTS buckets (
+        task TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT PRIMARY KEY,
+        message_id TEXT NOT NULL,
+        created REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idempotency_keys_created ON idempotency_keys (created);
+    """
+
+    # Kept up to date by sqlite as jobs are added, moved and deleted
+    COUNTERS = [
+        """
+        CREATE TABLE IF NOT EXISTS counts (
+            task TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (task, status)
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS jobs_added AFTER INSERT ON jobs BEGIN
+            INSERT INTO counts VALUES (new.task, new.status, 1)
+            ON CONFLICT (task, status) DO UPDATE SET count = count + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS jobs_moved AFTER UPDATE OF status ON jobs
+        WHEN old.status != new.status BEGIN
+            UPDATE counts SET count = count - 1 WHERE task = old.task AND status = old.status;
+            INSERT INTO counts VALUES (new.task, new.status, 1)
+            ON CONFLICT (task, status) DO UPDATE SET count = count + 1;
+        END
+        """,
+    ]
+
+    def __init__(self, tasks_path: str):
+        os.makedirs(tasks_path, exist_ok=True)
+        self.tasks_path = tasks_path
+        self.segments = {}
+        self.db_path = os.path.join(tasks_path, "kerground.db")
+        self.local = local()
+        self.inherited = []
+        self.connection().executescript(self.SCHEMA)
+        with self.transaction() as conn:
+            # Counted once for jobs saved before the counters existed
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            if version < 1:
+                for statement in self.COUNTERS:
+                    conn.execute(statement)
+                conn.execute(
+                    "INSERT OR REPLACE INTO counts SELECT task, status, COUNT(*) FROM jobs GROUP BY task, status"
+                )
+            if version < 2:
+                # Compacted jobs are still counted
+                conn.execute("DROP TRIGGER IF EXISTS jobs_deleted")
+                conn.execute("PRAGMA user_version = 2")
+
+    def connection(self):
+        # One connection per thread and per process, they can't be shared
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            if conn is not None:
+                # Inherited over fork, closing it here could release the parent locks
+                self.inherited.append(conn)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def put(self, message: dict):
+        self.insert([message])
+
+    def put_many(self, batch_id: str, messages: list):
+        self.insert(messages)
+
+    def put_unique(self, message: dict):
+        return self.insert([message], "OR IGNORE") == 1
+
+    def put_keyed(self, message: dict, key: str, keep):
+        with self.transaction() as conn:
+            saved = conn.execute(
+                "SELECT message_id, created FROM idempotency_keys WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if saved is not None and keep(*saved):
+                return saved[0]
+            self.insert_into(conn, [message])
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency_keys VALUES (?, ?, ?)",
+                (key, message["message_id"], time.time()),
+            )
+        return message["message_id"]
+
+    def purge_keys(self, ttl: int, keep):
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT key, message_id, created FROM idempotency_keys WHERE created < ?",
+                (time.time() - ttl,),
+            ).fetchall()
+            conn.executemany(
+                "DELETE FROM idempotency_keys WHERE key = ? AND message_id = ?",
+                [(key, i) for key, i, created in rows if not keep(i, created)],
+            )
+
+    def insert(self, messages: list, conflict: str = ""):
+        with self.transaction() as conn:
+            return self.insert_into(conn, messages, conflict)
+
+    def insert_into(self, conn, messages: list, conflict: str = ""):
+        now = time.time()
+        cursor = conn.executemany(
+            f"INSERT {conflict} INTO jobs VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?, ?)",
+            [
+                (
+                    message["message_id"],
+                    message["task"],
+                    "scheduled" if message.get("not_before") else "pending",
+                    self.serializer.dumps(message),
+                    now,
+                    now,
+                    message.get("not_before"),
+                    # Minus the priority so jobs come in index order
+                    -message.get("priority", 0),
+                )
+                for message in messages
+            ],
+        )
+        return cursor.rowcount
+
+    def status(self, message_id: str):
+        return self.statuses([message_id])[message_id]
+
+    def statuses(self, message_ids: list):
+        found = {}
+        # Kept under the number of parameters older sqlite versions accept
+        for ids in batch(message_ids, 500):
+            placeholders = ", ".join("?" * len(ids))
+            found.update(
+                self.connection().execute(
+                    f"SELECT message_id, status FROM jobs WHERE message_id IN ({placeholders})",
+                    ids,
+                )
+            )
+        # Compacted jobs are known by their result while it is kept
+        missing = [i for i in message_ids if i not in found]
+        for ids in batch(missing, 500):
+            placeholders = ", ".join("?" * len(ids))
+            found.update(
+                self.connection().execute(
+                    f"SELECT message_id, status FROM results WHERE message_id IN ({placeholders})",
+                    ids,
+                )
+            )
+        return {i: found.get(i, Status.UNKNOWN.value) for i in message_ids}
+
+    def iter_jobs(self, status: str, task: str = None):
+        for message, _ in self.versioned_jobs(status, task):
+            yield message
+
+    def iter_pending(self, task: str):
+        return self.versioned_jobs("pending", task)
+
+    def versioned_jobs(self, status: str, task: str = None):
+        assert status in JOB_STATUSES
+        # Read in small pages, continuing after the last job seen. The jobs
+        # of one task come by priority
+        if task is None:
+            query = "SELECT created, message_id, updated, message FROM jobs WHERE status = ? AND (created, message_id) > (?, ?) ORDER BY created, message_id LIMIT 100"
+            params, last = (status,), (0, "")
+        else:
+            query = "SELECT rank, created, message_id, updated, message FROM jobs WHERE status = ? AND task = ? AND (rank, created, message_id) > (?, ?, ?) ORDER BY rank, created, message_id LIMIT 100"
+            params, last = (status, task), (-(2**63), 0, "")
+        while True:
+            rows = self.connection().execute(query, (*params, *last)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                # Changed each time the job is saved again
+                yield self.serializer.loads(row[-1]), row[-2]
+            last = rows[-1][:-2]
+
+    def claim(
+        self,
+        task: str,
+        message_id: str,
+        worker_id: str,
+        lease: float,
+        limit: dict = None,
+        message: dict = None,
+        version=None,
+    ):
+        # Only one of the workers racing for the job still sees it pending
+        with self.transaction() as conn:
+            bucket = None
+            if limit is not None:
+                # Checked in the same transaction, no other worker can claim meanwhile
+                (running,) = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND task = ?",
+                    (task,),
+                ).fetchone()
+                bucket = conn.execute(
+                    "SELECT tokens, updated FROM buckets WHERE task = ?", (task,)
+                ).fetchone()
+                bucket = self.take(running, bucket, limit)
+            now = time.time()
+            claim = "UPDATE jobs SET status = 'running', updated = ?, worker = ?, lease_until = ? WHERE message_id = ? AND status = 'pending'"
+            params = (now, worker_id, now + lease, message_id)
+            cursor = None
+            if message is not None and version is not None:
+                # Still the same as when it was read
+                cursor = conn.execute(f"{claim} AND updated = ?", (*params, version))
+            if cursor is None or cursor.rowcount != 1:
+                message = None
+                cursor = conn.execute(claim, params)
+            if cursor.rowcount != 1:
+                return None
+            if bucket is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (task, *bucket)
+                )
+            if message is None:
+                (message,) = conn.execute(
+                    "SELECT message FROM jobs WHERE message_id = ?", (message_id,)
+                ).fetchone()
+                message = self.serializer.loads(message)
+        return message
+
+    def move(self, task: str, message_id: str, old: str, new: str):
+        assert old in JOB_STATUSES
+        assert new in JOB_STATUSES
+        return self.update(message_id, old, new)
+
+    def schedule(self, message: dict, old: str):
+        cursor = self.connection().execute(
+            "UPDATE jobs SET status = 'scheduled', message = ?, updated = ?, worker = NULL, lease_until = NULL, not_before = ? WHERE message_id = ? AND status = ?",
+            (
+                self.serializer.dumps(message),
+                time.time(),
+                message["not_before"],
+                message["message_id"],
+                old,
+            ),
+        )
+        return cursor.rowcount == 1
+
+    def scheduled(self):
+        rows = self.connection().execute(
+            "SELECT not_before, message_id, task FROM jobs WHERE status = 'scheduled'"
+        )
+        yield from rows
+
+    def next_due(self):
+        (due,) = (
+            self.connection()
+            .execute("SELECT MIN(not_before) FROM jobs WHERE status = 'scheduled'")
+            .fetchone()
+        )
+        return due
+
+    def promote(self, task: str, message_id: str):
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'pending', updated = ? WHERE message_id = ? AND status = 'scheduled'",
+                (time.time(), message_id),
+            )
+            if cursor.rowcount != 1:
+                return None
+            (message,) = conn.execute(
+                "SELECT message FROM jobs WHERE message_id = ?", (message_id,)
+            ).fetchone()
+        return self.serializer.loads(message)
+
+    def heartbeat(self, jobs: list):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE message_id = ? AND status = 'running'",
+                [(now + lease, message_id) for _, message_id, lease in jobs],
+            )
+
+    def reap(self, lease_for):
+        reaped = []
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT task, message_id, message FROM jobs WHERE status = 'running' AND lease_until < ?",
+                (time.time(),),
+            ).fetchall()
+            for task, message_id, message in rows:
+                message = self.serializer.loads(message)
+                status = self.requeue(message)
+                conn.execute(
+                    "UPDATE jobs SET status = ?, message = ?, updated = ?, worker = NULL, lease_until = NULL WHERE message_id = ?",
+                    (status, self.serializer.dumps(message), time.time(), message_id),
+                )
+                if status == Status.FAILED:
+                    self.save_result(message_id, status, "null", LEASE_EXPIRED)
+                reaped.append((task, message_id, status, message))
+        return reaped
+
+    def update(self, message_id: str, old: str, new: str):
+        cursor = self.connection().execute(
+            "UPDATE jobs SET status = ?, updated = ? WHERE message_id = ? AND status = ?",
+            (new, time.time(), message_id, old),
+        )
+        return cursor.rowcount == 1
+
+    def save_result(self, message_id: str, status: str, data: str, error: str):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+            (message_id, Status(status).value, data, error, time.time()),
+        )
+
+    def load_result(self, message_id: str, ttl: int = None):
+        row = (
+            self.connection()
+            .execute(
+                "SELECT status, result, traceback, finished FROM results WHERE message_id = ?",
+                (message_id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        status, data, error, finished = row
+        if ttl and time.time() - finished > ttl:
+            self.connection().execute(
+                "DELETE FROM results WHERE message_id = ?", (message_id,)
+            )
+            return None
+        return {"status": status, "result": json.loads(data), "traceback": error}
+
+    def purge_results(self, ttl: int):
+        self.connection().execute(
+            "DELETE FROM results WHERE finished < ?", (time.time() - ttl,)
+        )
+
+    def compact(self, keep: dict, archive: bool, results: bool):
+        now = time.time()
+        compacted = 0
+        for task, (ttl, max_count) in keep.items():
+            # Only the ids past the retention are read, off the index
+            queries, params = [], []
+            if ttl is not None:
+                queries.append(
+                    "SELECT message_id FROM jobs WHERE task = ? AND status IN ('done', 'failed') AND updated < ?"
+                )
+                params += [task, now - ttl]
+            if max_count is not None:
+                queries.append(
+                    "SELECT * FROM (SELECT message_id FROM jobs WHERE task = ? AND status IN ('done', 'failed') ORDER BY updated DESC LIMIT -1 OFFSET ?)"
+                )
+                params += [task, max_count]
+            if not queries:
+                continue
+            expired = self.connection().execute(" UNION ".join(queries), params)
+            # One short transaction per batch so workers are not held back
+            for ids in batch([message_id for (message_id,) in expired], 500):
+                with self.transaction() as conn:
+                    placeholders = ", ".join("?" * len(ids))
+                    rows = conn.execute(
+                        f"SELECT updated, status, message_id, message FROM jobs WHERE message_id IN ({placeholders}) AND status IN ('done', 'failed')",
+                        ids,
+                    ).fetchall()
+                    if archive and rows:
+                        self.archive(
+                            [(*row[:2], self.serializer.loads(row[3])) for row in rows]
+                        )
+                    deleted = [(row[2],) for row in rows]
+                    conn.executemany("DELETE FROM jobs WHERE message_id = ?", deleted)
+                    if results:
+                        conn.executemany(
+                            "DELETE FROM results WHERE message_id = ?", deleted
+                        )
+                compacted += len(rows)
+        return compacted
+
+    def counts(self, tasks: list):
+        counts = {status: {} for status in JOB_STATUSES}
+        rows = self.connection().execute("SELECT status, task, count FROM counts")
+        for status, task, count in rows:
+            counts[status][task] = count
+        return counts
+
+
+BACKENDS = {"file": FileBackend, "sqlite": SQLiteBackend}
+
+
+# Kerground params sent to the processes of the pool when they are spawned
+SETTINGS = [
+    "tasks_path",
+    "pool",
+    "processes",
+    "max_tasks_per_child",
+    "threads",
+    "coroutines",
+    "prefetch",
+    "result_ttl",
+    "result_max_size",
+    "visibility_timeout",
+    "job_ttl",
+    "job_max_count",
+    "archive",
+    "compact_every",
+    "log_level",
+    "log_json",
+    "blob_threshold",
+    "idempotency_ttl",
+    "serializer",
+]
+
+
+class Kerground:
+
+    MODE = Modes
+    STATUS = Status
+
+    @property
+    def worker_id(self):
+        return claimer()
+
+    def __init__(
+        self,
+        tasks_path: str = "./.kergroundtasks",
+        pool: int = 1,
+        processes: int = CPUS,
+        max_tasks_per_child: int = None,
+        threads: int = CPUS * 2,
+        coroutines: int = 1000,
+        prefetch: int = 100,
+        result_ttl: int = None,
+        result_max_size: int = None,
+        visibility_timeout: int = 60,
+        job_ttl: int = None,
+        job_max_count: int = None,
+        archive: bool = False,
+        compact_every: int = 60,
+        log_level: str = "INFO",
+        log_json: bool = False,
+        blob_threshold: int = 1024 * 1024,
+        idempotency_ttl: int = 24 * 3600,
+        serializer: Serializer = "json",
+        backend: Backend = "file",
+    ):
+        self.tasks = {}
+        self.pool = pool
+        self.processes = processes
+        self.max_tasks_per_child = max_tasks_per_child
+        self.threads = threads
+        self.coroutines = coroutines
+        self.prefetch = prefetch
+        self.prefetched = {}
+        self.queues = {}
+        self.queued = itertools.count()
+        self.served = {}
+        self.scans = {}
+        self.scanned = {}
+        self.new_jobs = set()
+        self.task_running = {}
+        self.blocked = {}
+        self.result_ttl = result_ttl
+        self.result_max_size = result_max_size
+        self.last_purge = time.monotonic()
+        self.idempotency_ttl = idempotency_ttl
+        self.last_key_purge = None
+        self.last_cache_purge = time.monotonic()
+        self.metrics = Metrics()
+        self.last_metrics = time.monotonic()
+        self.due_jobs = []
+        self.last_resync = None
+        self.last_due_check = time.monotonic()
+        self.periodic = {}
+        self.visibility_timeout = visibility_timeout
+        self.inflight = {}
+        self.heartbeat_thread = None
+        self.stopping = Event()
+        self.job_ttl = job_ttl
+        self.job_max_count = job_max_count
+        self.archive = archive
+        self.compact_every = compact_every
+        self.compactor_thread = None
+        self.log_level = log_level
+        self.log_json = log_json
+        self.log_listener = None
+        self.log_queue = None
+        self.process_pool = None
+        self.thread_pools = {}
+        self.loop = None
+        self.loop_thread = None
+        self.running = {}
+        self.slots_lock = Lock()
+        self.slot_freed = Event()
+        self.wakeup_sock = None
+        self.wakeup_address = None
+        self.notifier = None
+        if hasattr(socket, "AF_UNIX"):
+            self.notifier = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.notifier.setblocking(False)
+        self.tasks_path = tasks_path
+        self.wakeup_path = os.path.join(tasks_path, "wakeup")
+        self.waiters_path = os.path.join(tasks_path, "waiters")
+        self.metrics_path = os.path.join(tasks_path, "metrics")
+        for path in [self.wakeup_path, self.waiters_path, self.metrics_path]:
+            os.makedirs(path, exist_ok=True)
+        self.blob_threshold = blob_threshold
+        self.blobs = BlobStore(os.path.join(tasks_path, "blobs"))
+        self.cache = ResultCache(os.path.join(tasks_path, "cache"))
+        if isinstance(serializer, Serializer):
+            self.serializer = serializer
+        else:
+            assert (
+                serializer in SERIALIZERS
+            ), f"serializer must be one of {list(SERIALIZERS)}"
+            self.serializer = SERIALIZERS[serializer]()
+        if isinstance(backend, Backend):
+            self.backend = backend
+        else:
+            assert backend in BACKENDS, f"backend must be one of {list(BACKENDS)}"
+            self.backend = BACKENDS[backend](tasks_path)
+        self.backend.serializer = self.serializer
+        self.workflows = Workflows(
+            os.path.join(tasks_path, "workflows"), self.serializer
+        )
+
+    def __getstate__(self):
+        # Pickled for the processes of the pool when they are spawned rather
+        # than forked (macOS, Windows or `max_tasks_per_child`). Only the
+        # params and the tasks go, by name, the locks, sockets and pools of
+        # the worker are made again there
+        backend = self.backend
+        for name, cls in BACKENDS.items():
+            if type(backend) is cls:
+                backend = name
+        tasks = {
+            name: dict(
+                options, task=(options["task"].__module__, options["task"].__qualname__)
+            )
+            for name, options in self.tasks.items()
+        }
+        settings = {name: getattr(self, name) for name in SETTINGS}
+        return {"settings": settings, "backend": backend, "tasks": tasks}
+
+    def __setstate__(self, state: dict):
+        self.__init__(backend=state["backend"], **state["settings"])
+        for name, options in state["tasks"].items():
+            task = None
+            if options["mode"] == Modes.PROCESS:
+                # Imported like pickle does, the module runs its registrations
+                module, qualname = options["task"]
+                task = importlib.import_module(module)
+                for attr in qualname.split("."):
+                    task = getattr(task, attr)
+            self.tasks[name] = dict(options, task=task)
+
+    def register(
+        self,
+        *dargs,
+        mode: Modes = Modes.PROCESS,
+        max_retries: int = 0,
+        threads: int = None,
+        concurrency: int = None,
+        visibility_timeout: int = None,
+        retry_delay: float = 5,
+        retry_backoff: float = 2,
+        retry_max_delay: float = 600,
+        retry_jitter: bool = True,
+        schedule: str = None,
+        weight: float = 1,
+        quota: int = None,
+        rate_limit: str = None,
+        job_ttl: int = None,
+        job_max_count: int = None,
+        cache: bool = False,
+        cache_ttl: int = None,
+        cache_max_entries: int = None,
+    ):
+        # Mode can be given positionally like `@ker.register(ker.MODE.THREAD)`
+        if dargs and not callable(dargs[0]):
+            mode = Modes(dargs[0])
+
         def decorator(fn):
+            task_mode = Modes.ASYNC if inspect.iscoroutinefunction(fn) else mode
+            if task_mode == Modes.ASYNC:
+                assert inspect.iscoroutinefunction(
+                    fn
+                ), "async mode needs an `async def` task"
+            assert weight > 0, "weight must be a positive number"
+            assert (
+                cache_max_entries is None or cache_max_entries > 0
+            ), "cache_max_entries must be a positive number"
+            cron = parse_cron(schedule) if schedule else None
+            if cron is not None:
+                # Like "0 0 31 2 *", valid fields but no day they all match
+                cron_next(cron, time.time())
             self.tasks[fn.__name__] = {
                 "task": fn,
-                "mode": mode,
+                "mode": task_mode,
                 "max_retries": max_retries,
+                "threads": threads,
+                "concurrency": concurrency,
+                "visibility_timeout": visibility_timeout,
+                "retry_delay": retry_delay,
+                "retry_backoff": retry_backoff,
+                "retry_max_delay": retry_max_delay,
+                "retry_jitter": retry_jitter,
+                "schedule": cron,
+                "weight": weight,
+                "quota": quota,
+                "rate_limit": parse_rate(rate_limit) if rate_limit else None,
+                "job_ttl": job_ttl,
+                "job_max_count": job_max_count,
+                "cache": cache,
+                "cache_ttl": cache_ttl,
+                "cache_max_entries": cache_max_entries,
             }
 
             @wraps(fn)
@@ -155,171 +2263,1226 @@ class Kerground:
 
         return decorator(dargs[0]) if dargs and callable(dargs[0]) else decorator
 
-    def enqueue(self, fn: str, *args, **kwargs):
+    def enqueue(
+        self,
+        fn: str,
+        *args,
+        eta: datetime = None,
+        countdown: float = None,
+        priority: int = 0,
+        idempotency_key: str = None,
+        **kwargs,
+    ):
         task = fn if isinstance(fn, str) else fn.__name__
         assert task in self.tasks, "this task is not registered"
 
+        not_before = None
+        if countdown is not None:
+            not_before = time.time() + countdown
+        if eta is not None:
+            not_before = eta.timestamp() if isinstance(eta, datetime) else eta
+
         message_id = str(uuid.uuid4())
-        task_path = os.path.join(self.pending_path, f"{task}--{message_id}.json")
+        message = self.message(task, message_id, args, kwargs, not_before, priority)
+        key = None
+        if idempotency_key is not None:
+            key = self.idempotency_key(message, idempotency_key)
+        try:
+            if key is None:
+                self.backend.put(message)
+            else:
+                saved_id = self.backend.put_keyed(message, key, self.is_duplicate)
+        except BaseException:
+            # Never saved, nothing else would release its blobs
+            self.blobs.release(self.blobs.digests(message))
+            raise
+        if key is not None and saved_id != message_id:
+            # A duplicate, the event saved before is kept instead
+            self.blobs.release(self.blobs.digests(message))
+            return saved_id
+
+        if not_before is None:
+            self.notify_pending(task, message if priority > 0 else None)
+        else:
+            self.notify_due(not_before, message_id, task)
+        return message_id
+
+    def idempotency_key(self, message: dict, key: str):
+        # Keys are per task, with `True` the key is made of the args
+        if key is True:
+            key = json.dumps(
+                [message["args"], message["kwargs"]], sort_keys=True, default=repr
+            )
+        return f"{message['task']}:{key}"
+
+    def is_duplicate(self, message_id: str, created: float):
+        # An event enqueued again with the same key is a duplicate of the
+        # first one while that one waits or runs, or is done since recently
+        status = self.check_status(message_id)
+        if status == Status.DONE:
+            return time.time() - created < self.idempotency_ttl
+        return status not in [Status.FAILED.value, Status.UNKNOWN.value]
+
+    def enqueue_many(self, fn: str, iterable_of_args, priority: int = 0, **kwargs):
+        task = fn if isinstance(fn, str) else fn.__name__
+        assert task in self.tasks, "this task is not registered"
+
+        # A tuple holds the args of one call, anything else is its only arg
+        batch_id = str(uuid.uuid4())
+        messages = [
+            self.message(
+                task,
+                f"{batch_id}.{i}",
+                args if isinstance(args, tuple) else (args,),
+                kwargs,
+                priority=priority,
+            )
+            for i, args in enumerate(iterable_of_args)
+        ]
+        if not messages:
+            return []
+        try:
+            self.backend.put_many(batch_id, messages)
+        except BaseException:
+            for message in messages:
+                self.blobs.release(self.blobs.digests(message))
+            raise
+
+        self.notify_pending(task)
+        return [message["message_id"] for message in messages]
+
+    def step(self, fn: str, *args, **kwargs):
+        # One job of a workflow, enqueued by `chain`, `group` or `chord`
+        task = fn if isinstance(fn, str) else fn.__name__
+        assert task in self.tasks, "this task is not registered"
+        return {"task": task, "args": args, "kwargs": kwargs}
+
+    def chain(self, *stages):
+        # Each stage starts once the one before it is done and gets its
+        # result as first arg, a list of steps is a group which runs at
+        # once and passes the list of their results to the next stage
+        assert stages, "a chain needs at least one step"
+        steps = []
+        for stage in stages:
+            group = stage if isinstance(stage, (list, tuple)) else [stage]
+            assert group, "a group needs at least one step"
+            steps.append([s if isinstance(s, dict) else self.step(s) for s in group])
+        messages = [
+            [
+                self.message(s["task"], str(uuid.uuid4()), s["args"], s["kwargs"])
+                for s in group
+            ]
+            for group in steps
+        ]
+        ids = [[m["message_id"] for m in group] for group in messages]
+        saved = []
+        try:
+            # Saved before the first jobs so none of them finishes unnoticed
+            for i, group in enumerate(messages[1:]):
+                gather = isinstance(stages[i], (list, tuple))
+                for message in group:
+                    self.workflows.add(message, ids[i], gather)
+                for message_id in ids[i]:
+                    self.workflows.link(message_id, ids[i + 1])
+            for message in messages[0]:
+                self.backend.put(message)
+                saved.append(message)
+        except BaseException:
+            for group in messages:
+                for message in group:
+                    if message not in saved:
+                        self.blobs.release(self.blobs.digests(message))
+            for group in ids[1:]:
+                for message_id in group:
+                    self.workflows.remove(message_id)
+            raise
+
+        for task in {message["task"] for message in messages[0]}:
+            self.notify_pending(task)
+        return [
+            group if isinstance(stage, (list, tuple)) else group[0]
+            for stage, group in zip(stages, ids)
+        ]
+
+    def group(self, *steps):
+        return self.chain(list(steps))[0]
+
+    def chord(self, steps: list, callback):
+        # The callback gets the list of the results once all steps are done
+        return self.chain(list(steps), callback)
+
+    def advance(self, message_id: str):
+        # Called once the job is finished, starts the jobs waiting for it
+        for waiting_id in self.workflows.dependents(message_id):
+            self.start_waiting(waiting_id)
+        self.workflows.unlink(message_id)
+
+    def start_waiting(self, message_id: str):
+        step = self.workflows.load(message_id)
+        if step is None:
+            return
+        statuses = self.backend.statuses(step["after"])
+        finished = [Status.DONE.value, Status.FAILED.value]
+        if any(statuses[i] not in finished for i in step["after"]):
+            return
+        message = step["message"]
+        failed = [i for i in step["after"] if statuses[i] == Status.FAILED]
+        if failed:
+            # Not run, failed as soon as a worker takes it
+            message["failed_after"] = failed[0]
+            message["max_retries"] = 0
+        else:
+            results = [
+                self.backend.load_result(i, self.result_ttl) for i in step["after"]
+            ]
+            results = [r["result"] if r else None for r in results]
+            arg = results if step["gather"] else results[0]
+            message["args"] = [arg, *message["args"]]
+        message["enqueued"] = time.time()
+        # Only one of the workers finishing the jobs before it saves it
+        if self.backend.put_unique(message):
+            self.notify_pending(message["task"])
+        self.workflows.remove(message_id)
+        # Left by a worker which stopped before starting this job
+        for before_id in step["after"]:
+            self.workflows.unlink(before_id)
+
+    def message(
+        self,
+        task: str,
+        message_id: str,
+        args: tuple,
+        kwargs: dict,
+        not_before: float = None,
+        priority: int = 0,
+    ):
+        # Big bytes args are saved apart, the message holds references to them
+        args, kwargs = self.blobs.spill(args, kwargs, self.blob_threshold)
         message = {
             "message_id": message_id,
             "task": task,
             "mode": self.tasks[task]["mode"],
+            "priority": priority,
             "max_retries": self.tasks[task]["max_retries"],
+            "retries": 0,
             "args": args,
             "kwargs": kwargs,
+            "enqueued": time.time(),
         }
-        with open(task_path, mode="w") as jsonfile:
-            json.dump(message, jsonfile)
+        if not_before is not None:
+            message["not_before"] = not_before
+        return message
+
+    async def aenqueue(self, fn: str, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: self.enqueue(fn, *args, **kwargs)
+        )
+
+    async def aenqueue_many(self, fn: str, iterable_of_args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: self.enqueue_many(fn, list(iterable_of_args), **kwargs)
+        )
+
+    def waiter_prefix(self, message_id: str):
+        # Hashed so the socket path fits the 108 bytes of AF_UNIX addresses
+        return hashlib.sha1(message_id.encode()).hexdigest()[:16] + "-"
+
+    def listeners(self, path: str, prefix: str = ""):
+        # Only the sockets of this host, those of other hosts sharing the
+        # tasks_path can't be reached and are not removed from here
+        if self.notifier is None:
+            return []
+        addresses = []
+        for f in os.listdir(path):
+            if not f.startswith(prefix) or not f.endswith(".sock"):
+                continue
+            host = f[len(prefix) : -len(".sock")].rsplit("-", 2)[0]
+            if host == HOSTNAME:
+                addresses.append(os.path.join(path, f))
+        return addresses
+
+    def notify(self, addresses: list, data: bytes = b"1"):
+        if self.notifier is None:
+            return
+        for address in addresses:
+            try:
+                self.notifier.sendto(data, address)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The worker which listened on this address is gone
+                try:
+                    os.remove(address)
+                except OSError:
+                    pass
+            except OSError:
+                # Socket buffer is full, the worker has wakeups queued already
+                # and finds the due jobs it missed by itself
+                pass
 
-        return message_id
+    def notify_pending(self, task: str, message: dict = None):
+        # Prioritized jobs are sent whole so workers can run them right away
+        data = self.serializer.encode({"task": task} if message is None else message)
+        if len(data) > 4096:
+            data = self.serializer.encode({"task": task})
+        self.notify(self.listeners(self.wakeup_path), data)
+
+    def notify_due(self, not_before: float, message_id: str, task: str):
+        # Workers add it to the jobs they wait for, no need to read them all
+        data = self.serializer.encode([not_before, message_id, task])
+        self.notify(self.listeners(self.wakeup_path), data)
+
+    def listen_socket(self, path: str, prefix: str = ""):
+        if self.notifier is None:
+            return None, None
+        address = os.path.join(path, f"{prefix}{claimer()}-{uuid.uuid4().hex[:8]}.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.bind(address)
+            sock.setblocking(False)
+        except OSError:
+            # Polling only by the caller, notifications still sent
+            sock.close()
+            return None, None
+        return sock, address
+
+    def start_wakeup(self):
+        if self.wakeup_sock is None:
+            self.wakeup_sock, self.wakeup_address = self.listen_socket(self.wakeup_path)
+            if self.wakeup_sock is None and self.notifier is not None:
+                logger.warning("Notifications not available, polling for tasks")
+                self.notifier = None
+
+    def stop_wakeup(self):
+        if self.wakeup_sock is None:
+            return
+        self.wakeup_sock.close()
+        try:
+            os.remove(self.wakeup_address)
+        except OSError:
+            pass
+        self.wakeup_sock = None
+        self.wakeup_address = None
+
+    def clear_wakeups(self):
+        self.slot_freed.clear()
+        if self.wakeup_sock is None:
+            return
+        try:
+            while True:
+                data = self.wakeup_sock.recv(65536)
+                if data == b"1":
+                    continue
+                try:
+                    data = self.serializer.loads(data)
+                except ValueError:
+                    # Sent with another serializer, taken as a plain wakeup
+                    self.new_jobs.update(self.tasks)
+                    continue
+                if isinstance(data, list):
+                    heapq.heappush(self.due_jobs, tuple(data))
+                    continue
+                if "released" in data:
+                    self.blocked.pop(data["released"], None)
+                    continue
+                self.new_jobs.add(data["task"])
+                if "message_id" in data:
+                    self.queue(data)
+        except OSError:
+            pass
+
+    def wait_wakeup(self, timeout: float):
+        if self.wakeup_sock is None:
+            self.slot_freed.wait(timeout)
+        else:
+            select.select([self.wakeup_sock], [], [], timeout)
+
+    def wake(self):
+        # One wakeup pending is enough, more could fill the socket and the
+        # notifications about due jobs sent meanwhile would be dropped
+        if self.slot_freed.is_set():
+            return
+        self.slot_freed.set()
+        if self.wakeup_address is not None:
+            self.notify([self.wakeup_address])
 
     def check_status(self, message_id: str):
-        for status in ["pending", "running", "failed"]:
-            for task in os.listdir(os.path.join(self.tasks_path, status)):
-                if message_id in task:
-                    return status
-        return "done"
+        status = self.backend.status(message_id)
+        if status != Status.UNKNOWN:
+            return status
+        if self.workflows.is_waiting(message_id):
+            return Status.WAITING.value
+        # Saved and no longer waiting since read
+        return self.backend.status(message_id)
+
+    def check_statuses(self, message_ids: list):
+        statuses = self.backend.statuses(list(message_ids))
+        for message_id, status in statuses.items():
+            if status == Status.UNKNOWN:
+                statuses[message_id] = self.check_status(message_id)
+        return statuses
+
+    async def acheck_status(self, message_id: str):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.check_status, message_id)
+
+    def save_result(self, message_id: str, status: str, result=None, error=None):
+        # Gives back the result serialized, None when it couldn't be saved
+        try:
+            data = json.dumps(result)
+        except (TypeError, ValueError):
+            logger.warning(
+                "Result is not json serializable, not saved",
+                extra={"message_id": message_id},
+            )
+            data = None
+        if data and self.result_max_size and len(data) > self.result_max_size:
+            logger.warning(
+                "Result is over %s bytes, not saved",
+                self.result_max_size,
+                extra={"message_id": message_id},
+            )
+            data = None
+        self.backend.save_result(message_id, status, data or "null", error)
+        return data
+
+    def load_result(self, message_id: str):
+        message = self.backend.load_result(message_id, self.result_ttl)
+        if message is None:
+            return None
+        if message["status"] == Status.FAILED:
+            raise TaskError(message["traceback"])
+        return message["result"]
+
+    def purge_results(self):
+        self.backend.purge_results(self.result_ttl)
+
+    def get_result(self, message_id: str, timeout: float = None):
+        finished = [Status.DONE.value, Status.FAILED.value]
+        status = self.check_status(message_id)
+        if status == Status.UNKNOWN:
+            raise KeyError(f"Unknown message id '{message_id}'")
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        sock, address = None, None
+        if status not in finished:
+            sock, address = self.listen_socket(
+                self.waiters_path, self.waiter_prefix(message_id)
+            )
+            if sock is None:
+                logger.debug("Notifications not available, polling for the result")
+            # Checked again once listening so the worker notification is not missed
+            status = self.check_status(message_id)
+        try:
+            while status not in finished:
+                wait = self.pool if sock is not None else 0.1
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            f"Task '{message_id}' did not finish in time"
+                        )
+                    wait = min(wait, remaining)
+                if sock is None:
+                    time.sleep(wait)
+                else:
+                    select.select([sock], [], [], wait)
+                status = self.check_status(message_id)
+        finally:
+            if sock is not None:
+                sock.close()
+                try:
+                    os.remove(address)
+                except FileNotFoundError:
+                    # Removed by a worker which notified it once closed
+                    pass
+
+        return self.load_result(message_id)
+
+    async def aget_result(self, message_id: str, timeout: float = None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: self.get_result(message_id, timeout)
+        )
 
     def load_jobs(self, status: str):
-        assert status in ["pending", "running", "failed", "done"]
-        jobs = []
-        jobs_path = os.path.join(self.tasks_path, status)
-        for path in [os.path.join(jobs_path, f) for f in os.listdir(jobs_path)]:
-            with open(path, "r") as jsonfile:
-                message = json.load(jsonfile)
-                jobs.append(message)
-        return jobs
+        return self.backend.jobs(status)
 
     def move(self, message_id: str, old: str, new: str):
-        assert old in ["pending", "running", "failed", "done"]
-        assert new in ["pending", "running", "failed", "done"]
-        src = os.path.join(self.tasks_path, old, f"{message_id}.json")
-        dst = os.path.join(self.tasks_path, new, f"{message_id}.json")
-        shutil.move(src, dst)
-
-    def run(self, fn: str, message_id: str, max_retries: int, *args, **kwargs):
-        try:
-            print(f"Working on '{fn}--{message_id}'...")
-            start = time.perf_counter()
-            result = self.tasks[fn]["task"](*args, **kwargs)
-            self.move(f"{fn}--{message_id}", "running", "done")
-            print(
-                f"Successfully finished '{fn}-{message_id}' in {time.perf_counter() - start} seconds!"
+        self.backend.move(*message_id.split("--", 1), old, new)
+
+    def lost_lease(self, fn: str, message_id: str):
+        logger.warning(
+            "Lease expired before the job finished, it may run again",
+            extra={"task": fn, "message_id": message_id},
+        )
+
+    def log_fields(self, job: dict, start: float = None, **fields):
+        # Structured fields of the log events of a job
+        fields["task"] = job["task"]
+        fields["message_id"] = job["message_id"]
+        fields["attempt"] = job.get("retries", 0) + 1
+        if start is not None:
+            fields["duration"] = round(time.perf_counter() - start, 6)
+        return fields
+
+    def succeeded(self, job: dict, start: float, result, cached: bool = False):
+        fn, message_id = job["task"], job["message_id"]
+        data = self.save_result(message_id, Status.DONE, result)
+        options = self.tasks[fn]
+        if options["cache"] and not cached and data is not None:
+            key = self.cache.key(job["args"], job["kwargs"])
+            self.cache.put(fn, key, data, options["cache_max_entries"])
+        if self.backend.move(fn, message_id, "running", "done"):
+            self.blobs.release(self.blobs.digests(job))
+            self.advance(message_id)
+        else:
+            self.lost_lease(fn, message_id)
+        self.notify(self.listeners(self.waiters_path, self.waiter_prefix(message_id)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Job done", extra=self.log_fields(job, start))
+        return Status.DONE.value, time.perf_counter() - start
+
+    def cached(self, job: dict):
+        # The result of an earlier job of the task with the same args
+        options = self.tasks[job["task"]]
+        key = self.cache.key(job["args"], job["kwargs"])
+        data = self.cache.get(job["task"], key, options["cache_ttl"])
+        self.metrics.count(
+            "cache_misses" if data is None else "cache_hits", job["task"]
+        )
+        return data
+
+    def retry_delay(self, task: str, retries: int):
+        options = self.tasks[task]
+        delay = min(
+            options["retry_delay"] * options["retry_backoff"] ** retries,
+            options["retry_max_delay"],
+        )
+        if options["retry_jitter"]:
+            # Spread the retries of jobs which failed at the same time
+            delay = random.uniform(delay / 2, delay)
+        return delay
+
+    def failed(self, job: dict, start: float, error: Exception = None):
+        # The exception being handled, or `error` when called from elsewhere
+        fn, message_id = job["task"], job["message_id"]
+        exc_info = True if error is None else error
+        retries = job.get("retries", 0)
+        if retries < job["max_retries"]:
+            # Scheduled again instead of waiting here, the slot is free meanwhile
+            delay = self.retry_delay(fn, retries)
+            not_before = time.time() + delay
+            logger.warning(
+                "Job failed, retrying in %.2f seconds",
+                delay,
+                exc_info=exc_info,
+                extra=self.log_fields(job, start, delay=round(delay, 3)),
             )
-            return result
+            retry = dict(job, retries=retries + 1, not_before=not_before)
+            if self.backend.schedule(retry, "running"):
+                self.notify_due(not_before, message_id, fn)
+            else:
+                self.lost_lease(fn, message_id)
+            return "retried", time.perf_counter() - start
+        logger.error("Job failed", exc_info=exc_info, extra=self.log_fields(job, start))
+        if error is None:
+            error = traceback.format_exc()
+        else:
+            error = "".join(
+                traceback.format_exception(type(error), error, error.__traceback__)
+            )
+        self.save_result(message_id, Status.FAILED, error=error)
+        if self.backend.move(fn, message_id, "running", "failed"):
+            self.blobs.release(self.blobs.digests(job))
+            self.advance(message_id)
+        else:
+            self.lost_lease(fn, message_id)
+        self.notify(self.listeners(self.waiters_path, self.waiter_prefix(message_id)))
+        return Status.FAILED.value, time.perf_counter() - start
+
+    def run_job(self, job: dict):
+        # Gives back how it went and how long it took
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Job started", extra=self.log_fields(job))
+        start = time.perf_counter()
+        mapped = []
+        try:
+            if "failed_after" in job:
+                raise TaskError(f"Not run, job {job['failed_after']} before it failed")
+            args, kwargs = self.blobs.load(job["args"], job["kwargs"], mapped)
+            result = self.tasks[job["task"]]["task"](*args, **kwargs)
         except Exception:
-            print(traceback.format_exc())
-            print(f"Failed executing '{fn}-{message_id}'...")
-            if max_retries > 0:
-                print("Retrying...")
-                time.sleep(5)
-                max_retries -= 1
-                return self.run(fn, message_id, max_retries, *args, **kwargs)
-            self.move(f"{fn}--{message_id}", "running", "failed")
-
-    def run_sync(self, fn, tasks_sync):
-        for t in tasks_sync:
-            self.run(fn, t["message_id"], t["max_retries"], *t["args"], *t["kwargs"])
-
-    def run_processes(self, fn, tasks_processes):
-
-        procs = []
-        for t in tasks_processes:
-            p = Process(
-                target=self.run,
-                args=(fn, t["message_id"], t["max_retries"], *t["args"], *t["kwargs"]),
+            return self.failed(job, start)
+        finally:
+            self.blobs.close(mapped)
+        return self.succeeded(job, start, result)
+
+    async def arun_job(self, job: dict):
+        # Only the task runs on the event loop, saving how it went waits on
+        # files and locks and is done by a thread
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Job started", extra=self.log_fields(job))
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        mapped = []
+        try:
+            if "failed_after" in job:
+                raise TaskError(f"Not run, job {job['failed_after']} before it failed")
+            args, kwargs = self.blobs.load(job["args"], job["kwargs"], mapped)
+            result = await self.tasks[job["task"]]["task"](*args, **kwargs)
+        except Exception as error:
+            return await loop.run_in_executor(None, self.failed, job, start, error)
+        finally:
+            self.blobs.close(mapped)
+        return await loop.run_in_executor(None, self.succeeded, job, start, result)
+
+    def slot_for(self, job: dict):
+        if job["mode"] == Modes.THREAD and self.tasks[job["task"]]["threads"]:
+            return f"{Modes.THREAD.value}:{job['task']}"
+        return Modes(job["mode"]).value
+
+    def slot_size(self, slot: str):
+        if slot == Modes.PROCESS:
+            return self.processes
+        if slot == Modes.THREAD:
+            return self.threads
+        if slot == Modes.ASYNC:
+            return self.coroutines
+        return self.tasks[slot.split(":", 1)[1]]["threads"]
+
+    def has_free_slot(self, job: dict):
+        quota = self.tasks[job["task"]]["quota"]
+        if quota is not None and self.task_running.get(job["task"], 0) >= quota:
+            return False
+        if self.blocked.get(job["task"], 0) > time.monotonic():
+            return False
+        if job["mode"] == Modes.SYNC:
+            return True
+        slot = self.slot_for(job)
+        with self.slots_lock:
+            return self.running.get(slot, 0) < self.slot_size(slot)
+
+    def acquire_slot(self, slot: str):
+        with self.slots_lock:
+            running = self.running.get(slot, 0)
+            if running >= self.slot_size(slot):
+                return False
+            self.running[slot] = running + 1
+            return True
+
+    def release_slot(self, slot: str):
+        with self.slots_lock:
+            self.running[slot] -= 1
+        self.wake()
+
+    def finished(self, job: dict, slot: str, outcome=None):
+        # None when the job broke the worker, the pool gives the exception
+        if isinstance(outcome, tuple):
+            status, runtime = outcome
+            self.metrics.count(status, job["task"])
+            self.metrics.observe("run", job["task"], runtime)
+        with self.slots_lock:
+            self.inflight.pop(job["message_id"], None)
+            self.task_running[job["task"]] -= 1
+        if self.tasks[job["task"]]["concurrency"] is not None:
+            # Workers waiting to run this task can try again
+            self.blocked.pop(job["task"], None)
+            data = self.serializer.encode({"released": job["task"]})
+            self.notify(self.listeners(self.wakeup_path), data)
+        if slot is not None:
+            self.release_slot(slot)
+
+    def limit_for(self, task: str):
+        options = self.tasks[task]
+        if options["concurrency"] is None and options["rate_limit"] is None:
+            return None
+        return {"concurrency": options["concurrency"], "rate": options["rate_limit"]}
+
+    def lease_for(self, task: str):
+        timeout = self.tasks.get(task, {}).get("visibility_timeout")
+        return timeout or self.visibility_timeout
+
+    def start(self, job: dict, version=None):
+        slot = None if job["mode"] == Modes.SYNC else self.slot_for(job)
+        if slot is not None and not self.acquire_slot(slot):
+            return False
+        lease = self.lease_for(job["task"])
+        limit = self.limit_for(job["task"])
+        try:
+            claimed = self.backend.claim(
+                job["task"],
+                job["message_id"],
+                self.worker_id,
+                lease,
+                limit,
+                job,
+                version,
+            )
+        except Limited as limited:
+            # The task waits, its jobs are left for later
+            wait = self.pool if limited.wait is None else limited.wait
+            self.blocked[job["task"]] = time.monotonic() + wait
+            self.queue(job, version)
+            claimed = None
+        if claimed is None:
+            # Another worker claimed it first
+            if slot is not None:
+                with self.slots_lock:
+                    self.running[slot] -= 1
+            return False
+        job = claimed
+        with self.slots_lock:
+            self.inflight[job["message_id"]] = job["task"]
+            self.task_running[job["task"]] = self.task_running.get(job["task"], 0) + 1
+        self.metrics.count("started", job["task"])
+        if "enqueued" in job:
+            # From when it was enqueued, or due when it was scheduled
+            waited = time.time() - max(job["enqueued"], job.get("not_before") or 0)
+            self.metrics.observe("wait", job["task"], max(0, waited))
+
+        if self.tasks[job["task"]]["cache"] and "failed_after" not in job:
+            data = self.cached(job)
+            if data is not None:
+                # Done right away, the task doesn't run again for the same args
+                outcome = None
+                try:
+                    start = time.perf_counter()
+                    outcome = self.succeeded(job, start, json.loads(data), cached=True)
+                finally:
+                    self.finished(job, slot, outcome)
+                return True
+
+        if job["mode"] == Modes.PROCESS:
+            self.run_process(job)
+        elif job["mode"] == Modes.THREAD:
+            self.run_thread(job, slot)
+        elif job["mode"] == Modes.ASYNC:
+            self.run_coroutine(job, slot)
+        else:
+            outcome = None
+            try:
+                outcome = self.run_job(job)
+            finally:
+                self.finished(job, slot, outcome)
+        return True
+
+    def start_heartbeat(self):
+        if self.heartbeat_thread is None:
+            self.stopping.clear()
+            self.heartbeat_thread = Thread(
+                target=self.heartbeat, name="kerground-heartbeat", daemon=True
             )
-            p.start()
-            procs.append(p)
-        for proc in procs:
-            proc.join()
-
-    def run_threads(self, fn, tasks_threads):
-        threads = []
-        for t in tasks_threads:
-            t = Thread(
-                target=self.run,
-                args=(fn, t["message_id"], t["max_retries"], *t["args"], *t["kwargs"]),
+            self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        if self.heartbeat_thread is not None:
+            self.stopping.set()
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    def heartbeat(self):
+        # Renews the leases of the jobs running here and gives the ones of
+        # workers which stopped renewing theirs back to pending
+        timeouts = [t["visibility_timeout"] for t in self.tasks.values()]
+        interval = min(t for t in timeouts + [self.visibility_timeout] if t) / 3
+        while not self.stopping.wait(interval):
+            try:
+                with self.slots_lock:
+                    jobs = [
+                        (task, message_id, self.lease_for(task))
+                        for message_id, task in self.inflight.items()
+                    ]
+                if jobs:
+                    self.backend.heartbeat(jobs)
+                for task in self.backend.recover():
+                    self.notify_pending(task)
+                reaped = self.backend.reap(self.lease_for)
+                for task, message_id, status, message in reaped:
+                    logger.warning(
+                        "Lease expired, job moved to %s",
+                        status,
+                        extra={
+                            "task": task,
+                            "message_id": message_id,
+                            "status": status,
+                        },
+                    )
+                    self.metrics.count("expired", task)
+                    if status == Status.FAILED:
+                        self.blobs.release(self.blobs.digests(message))
+                        self.advance(message_id)
+                        self.notify(
+                            self.listeners(
+                                self.waiters_path, self.waiter_prefix(message_id)
+                            )
+                        )
+                    else:
+                        self.notify_pending(task)
+                # Jobs left waiting by a worker which stopped before it
+                # started them
+                for message_id in self.workflows.waiting():
+                    self.start_waiting(message_id)
+            except Exception:
+                logger.exception("Heartbeat failed")
+
+    def retention(self):
+        # How long and how many finished jobs of each task are kept
+        keep = {}
+        for task, options in self.tasks.items():
+            ttl = options["job_ttl"] or self.job_ttl
+            max_count = options["job_max_count"] or self.job_max_count
+            if ttl is not None or max_count is not None:
+                keep[task] = (ttl, max_count)
+        return keep
+
+    def start_compactor(self):
+        if self.compactor_thread is None and self.retention():
+            self.stopping.clear()
+            self.compactor_thread = Thread(
+                target=self.compactor, name="kerground-compactor", daemon=True
             )
-            t.start()
-            threads.append(t)
-        for thread in threads:
-            thread.join()
-
-    def work(self):
-
-        pending_jobs = self.load_jobs("pending")
-        if not pending_jobs:
-            time.sleep(self.pool)
-
-        for key, value in groupby(pending_jobs, key=itemgetter("task")):
-
-            tasks = [k for k in value]
-            tasks_processes = [t for t in tasks if t["mode"] == Modes.PROCESS]
-            tasks_threads = [t for t in tasks if t["mode"] == Modes.THREAD]
-            tasks_sync = [t for t in tasks if t["mode"] == Modes.SYNC]
-
-            print(f"Started '{key}' with {len(tasks)} tasks")
+            self.compactor_thread.start()
+
+    def stop_compactor(self):
+        if self.compactor_thread is not None:
+            self.stopping.set()
+            self.compactor_thread.join()
+            self.compactor_thread = None
+
+    def compactor(self):
+        # Archives or drops the finished jobs past the retention, their
+        # results are kept for `result_ttl` or else dropped along with them
+        while not self.stopping.wait(self.compact_every):
+            try:
+                compacted = self.backend.compact(
+                    self.retention(), self.archive, self.result_ttl is None
+                )
+                if compacted:
+                    logger.info("Compacted %s finished jobs", compacted)
+            except Exception:
+                logger.exception("Compaction failed")
+
+    def load_archived_jobs(self, task: str = None):
+        return self.backend.archived(task)
+
+    def start_logging(self):
+        # Events are put on a queue and written by a thread of the worker,
+        # the processes of the pool inherit the queue
+        if self.log_listener is not None:
+            return
+        logger.setLevel(self.log_level)
+        handlers = logger.handlers or logging.getLogger().handlers
+        if not handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(LogFormatter(self.log_json))
+            handlers = [handler]
+        queue = self.log_queue = self.process_context().Queue(-1)
+        logger.handlers = [LogQueueHandler(queue)]
+        logger.propagate = False
+        self.log_listener = logging.handlers.QueueListener(
+            queue, *handlers, respect_handler_level=True
+        )
+        self.log_listener.start()
+        _log_handlers[:] = handlers
+
+    def stop_logging(self):
+        if self.log_listener is not None:
+            _log_handlers.clear()
+            self.log_listener.stop()
+            logger.handlers = []
+            logger.propagate = True
+            self.log_listener = None
+            self.log_queue = None
+
+    def process_context(self):
+        # Recycled processes are spawned, they can't be forked
+        if self.max_tasks_per_child is not None:
+            return get_context("spawn")
+        return get_context()
+
+    def start_process_pool(self):
+        if self.process_pool is None:
+            # Recycling processes needs Python 3.11
+            recycle = {}
+            if self.max_tasks_per_child is not None:
+                recycle["max_tasks_per_child"] = self.max_tasks_per_child
+            self.process_pool = ProcessPoolExecutor(
+                self.processes,
+                mp_context=self.process_context(),
+                initializer=_init_process,
+                initargs=(self, self.log_queue),
+                **recycle,
+            )
+        return self.process_pool
+
+    def broken_process_pool(self, process_pool: ProcessPoolExecutor):
+        # A process of the pool died (killed, out of memory, crashed), the
+        # pool fails all its jobs and can't take more, the next job starts
+        # a new one
+        with self.slots_lock:
+            if self.process_pool is not process_pool:
+                return
+            self.process_pool = None
+        process_pool.shutdown(wait=False)
+
+    def start_thread_pool(self, slot: str):
+        if slot not in self.thread_pools:
+            self.thread_pools[slot] = ThreadPoolExecutor(
+                self.slot_size(slot), thread_name_prefix=f"kerground-{slot}"
+            )
+        return self.thread_pools[slot]
 
-            for t in tasks:
-                self.move(f"{t['task']}--{t['message_id']}", "pending", "running")
+    def start_event_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = Thread(
+                target=self.loop.run_forever, name="kerground-async", daemon=True
+            )
+            self.loop_thread.start()
+        return self.loop
+
+    def stop_pools(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=True)
+            self.process_pool = None
+        for thread_pool in self.thread_pools.values():
+            thread_pool.shutdown(wait=True)
+        self.thread_pools = {}
+        if self.loop is not None:
+
+            async def drain():
+                current = asyncio.current_task()
+                tasks = [t for t in asyncio.all_tasks() if t is not current]
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            asyncio.run_coroutine_threadsafe(drain(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+            self.loop = None
+
+    def run_process(self, job: dict):
+        process_pool = self.start_process_pool()
+        try:
+            future = process_pool.submit(_run_in_process, job)
+        except BrokenProcessPool:
+            self.broken_process_pool(process_pool)
+            process_pool = self.start_process_pool()
+            future = process_pool.submit(_run_in_process, job)
+        future.add_done_callback(
+            lambda future: self.process_finished(job, process_pool, future)
+        )
+
+    def process_finished(self, job: dict, process_pool, future):
+        if isinstance(future.exception(), BrokenProcessPool):
+            # No longer in inflight once finished, its lease isn't renewed
+            # and the job is reaped like the ones of a worker which is gone
+            logger.warning(
+                "Worker process died, job given back when its lease expires",
+                extra={"task": job["task"], "message_id": job["message_id"]},
+            )
+            self.broken_process_pool(process_pool)
+        self.finished(job, Modes.PROCESS.value, self.outcome(future))
+
+    def run_thread(self, job: dict, slot: str):
+        future = self.start_thread_pool(slot).submit(self.run_job, job)
+        future.add_done_callback(
+            lambda future: self.finished(job, slot, self.outcome(future))
+        )
+
+    def run_coroutine(self, job: dict, slot: str):
+        future = asyncio.run_coroutine_threadsafe(
+            self.arun_job(job), self.start_event_loop()
+        )
+        future.add_done_callback(
+            lambda future: self.finished(job, slot, self.outcome(future))
+        )
+
+    def outcome(self, future):
+        return None if future.exception() is not None else future.result()
 
-            if tasks_sync:
-                self.run_sync(key, tasks_sync)
+    def work(self):
 
-            if tasks_processes:
-                for b in list(batch(tasks_processes, CPUS)):
-                    self.run_processes(key, b)
+        self.start_logging()
+        self.start_wakeup()
+        self.start_heartbeat()
+        self.start_compactor()
+        # Cleared before loading so a wakeup sent meanwhile is not missed
+        self.clear_wakeups()
+
+        # Scheduled jobs are kept in a heap by due time, read once and then
+        # added as workers are notified about them, read again once in a
+        # while or as soon as one missing from the heap is due first
+        now = time.time()
+        self.schedule_periodic(now)
+        resync = 60 if self.notifier is not None else self.pool
+        if (
+            self.last_resync is None
+            or time.monotonic() - self.last_resync > resync
+            or self.due_missed()
+        ):
+            self.due_jobs = list(self.backend.scheduled())
+            heapq.heapify(self.due_jobs)
+            self.last_resync = time.monotonic()
+        while self.due_jobs and self.due_jobs[0][0] <= now:
+            _, message_id, task = heapq.heappop(self.due_jobs)
+            # None when another worker promoted it first
+            job = self.backend.promote(task, message_id)
+            if job is not None:
+                self.queue(job)
+
+        started = sum(self.refill(task) for task in self.tasks)
+        started += self.dispatch()
+
+        if self.result_ttl and time.monotonic() - self.last_purge > self.result_ttl:
+            self.purge_results()
+            self.last_purge = time.monotonic()
+
+        if (
+            self.last_key_purge is None
+            or time.monotonic() - self.last_key_purge > self.idempotency_ttl
+        ):
+            self.backend.purge_keys(self.idempotency_ttl, self.is_duplicate)
+            self.last_key_purge = time.monotonic()
+
+        cache_ttls = {
+            task: options["cache_ttl"]
+            for task, options in self.tasks.items()
+            if options["cache"] and options["cache_ttl"]
+        }
+        if cache_ttls and time.monotonic() - self.last_cache_purge > min(
+            cache_ttls.values()
+        ):
+            self.cache.purge(cache_ttls)
+            self.last_cache_purge = time.monotonic()
+
+        if time.monotonic() - self.last_metrics > METRICS_EVERY:
+            self.save_metrics()
+            self.last_metrics = time.monotonic()
+
+        # Nothing could be started, wait for new jobs or a free slot
+        # polling every `pool` seconds in case a notification was missed
+        if not started:
+            timeout = self.pool
+            if self.due_jobs:
+                timeout = min(timeout, self.due_jobs[0][0] - time.time())
+            blocked = [t for t in self.blocked.values() if t > time.monotonic()]
+            if blocked:
+                timeout = min(timeout, min(blocked) - time.monotonic())
+            self.wait_wakeup(max(0, timeout))
+
+    def due_missed(self):
+        # Checked every `pool` seconds, a job due before the first one known
+        # here was scheduled while the wakeup socket of this worker was full
+        if time.monotonic() - self.last_due_check < self.pool:
+            return False
+        self.last_due_check = time.monotonic()
+        due = self.backend.next_due()
+        return due is not None and (not self.due_jobs or due < self.due_jobs[0][0])
+
+    def queue(self, job: dict, version=None):
+        # Each task waits in its own queue of at most `prefetch` jobs, along
+        # with the version of the job when it was read
+        task = job["task"]
+        if task not in self.tasks or job["message_id"] in self.prefetched:
+            return
+        queue = self.queues.setdefault(task, [])
+        priority = -job.get("priority", 0)
+        if len(queue) >= self.prefetch:
+            # Full, a job with a higher priority takes the place of the last
+            # one which is read again later
+            last = max(queue)
+            if priority >= last[0]:
+                return
+            queue.remove(last)
+            heapq.heapify(queue)
+            del self.prefetched[last[2]["message_id"]]
+        if not queue:
+            # A task back from idle doesn't get the turns it missed meanwhile
+            active = [self.served[t] for t, q in self.queues.items() if q]
+            self.served[task] = max(self.served.get(task, 0), min(active, default=0))
+        self.prefetched[job["message_id"]] = version
+        heapq.heappush(queue, (priority, next(self.queued), job))
+
+    def refill(self, task: str):
+        # Pending jobs are read lazily, the scan of a task resumes from where
+        # it stopped and starts over once notified about new jobs, every
+        # `pool` seconds otherwise in case a notification was lost
+        started = 0
+        queue = self.queues.setdefault(task, [])
+        if len(queue) >= self.prefetch:
+            return started
+        if self.scans.get(task) is None:
+            elapsed = time.monotonic() - self.scanned.get(task, 0)
+            if task not in self.new_jobs and elapsed < self.pool:
+                return started
+            self.new_jobs.discard(task)
+            self.scanned[task] = time.monotonic()
+            self.scans[task] = self.backend.iter_pending(task)
+        for read, (job, version) in enumerate(self.scans[task], 1):
+            self.queue(job, version)
+            # Started while being read as long as there are free slots
+            if self.has_free_slot(job):
+                started += self.dispatch()
+            # Other tasks get their turn to be read too
+            if len(queue) >= self.prefetch or read >= self.prefetch:
+                break
+        else:
+            self.scans[task] = None
+        return started
 
-            if tasks_threads:
-                for b in list(batch(tasks_threads, CPUS * 2)):
-                    self.run_threads(key, b)
+    def dispatch(self):
+        # Highest priority first, between tasks with jobs of the same
+        # priority the one which got the fewest turns for its weight
+        started = 0
+        while True:
+            best = None
+            for task, queue in self.queues.items():
+                if queue and self.has_free_slot(queue[0][2]):
+                    key = (queue[0][0], self.served[task])
+                    if best is None or key < best[0]:
+                        best = (key, task)
+            if best is None:
+                return started
+            task = best[1]
+            job = heapq.heappop(self.queues[task])[2]
+            version = self.prefetched.pop(job["message_id"])
+            if self.start(job, version):
+                self.served[task] += 1 / self.tasks[task]["weight"]
+                started += 1
+
+    def schedule_periodic(self, now: float):
+        # The next run of a periodic task is scheduled ahead, its id is made
+        # of its time so it's added once however many workers try
+        for task, options in self.tasks.items():
+            if options["schedule"] is None or self.periodic.get(task, 0) > now:
+                continue
+            not_before = cron_next(options["schedule"], now)
+            message_id = f"{task}@{int(not_before)}"
+            message = self.message(task, message_id, (), {}, not_before)
+            if self.backend.put_unique(message):
+                self.notify_due(not_before, message_id, task)
+            heapq.heappush(self.due_jobs, (not_before, message_id, task))
+            self.periodic[task] = not_before
 
     def listen(self):
-        print("Listening...")
+        self.start_logging()
+        self.backend.start()
+        logger.info("Listening...")
         while True:
             try:
                 self.work()
             except KeyboardInterrupt:
-                print("Stopped")
+                logger.info("Stopping...")
+                self.stop_pools()
+                self.stop_heartbeat()
+                self.stop_compactor()
+                self.stop_wakeup()
+                self.save_metrics()
+                logger.info("Stopped")
+                self.stop_logging()
                 break
 
-    def count(self, tasks):
-        counttasks = {}
-        for t in tasks:
-            if t not in counttasks:
-                counttasks[t] = 0
-            counttasks[t] = counttasks[t] + 1
-        return counttasks
-
     def get_current_tasks(self):
 
-        pending = self.count([i.split("--")[0] for i in os.listdir(self.pending_path)])
-        running = self.count([i.split("--")[0] for i in os.listdir(self.running_path)])
-        failed = self.count([i.split("--")[0] for i in os.listdir(self.failed_path)])
-        done = self.count([i.split("--")[0] for i in os.listdir(self.done_path)])
+        counts = self.backend.counts(list(self.tasks))
 
         tasks = []
         for task in self.tasks.keys():
             t = {
                 "task": task,
-                "pending": pending.get(task, 0),
-                "running": running.get(task, 0),
-                "failed": failed.get(task, 0),
-                "done": done.get(task, 0),
+                "scheduled": counts["scheduled"].get(task, 0),
+                "pending": counts["pending"].get(task, 0),
+                "running": counts["running"].get(task, 0),
+                "failed": counts["failed"].get(task, 0),
+                "done": counts["done"].get(task, 0),
             }
             tasks.append(t)
 
         return tasks
 
+    def write_metrics(self, path: str, snapshot: dict):
+        # Written to a temporary file first so readers never see a partial file
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, mode="w") as jsonfile:
+            json.dump(snapshot, jsonfile)
+        os.replace(tmp, path)
+
+    def save_metrics(self):
+        snapshot = self.metrics.snapshot()
+        with self.slots_lock:
+            snapshot["slots"] = {
+                slot: {"size": self.slot_size(slot), "busy": busy}
+                for slot, busy in self.running.items()
+            }
+        snapshot["updated"] = time.time()
+        path = os.path.join(self.metrics_path, f"{self.worker_id}.json")
+        self.write_metrics(path, snapshot)
+        self.retire_metrics()
+
+    def retire_metrics(self):
+        # The totals of the workers of this host which are gone are added to
+        # retired.json so there is no file left behind for each of them
+        for f in os.listdir(self.metrics_path):
+            host, _, pid = f[: -len(".json")].rpartition("-")
+            if host != HOSTNAME or not pid.isdigit() or not f.endswith(".json"):
+                continue
+            if pid_alive(int(pid)):
+                continue
+            path = os.path.join(self.metrics_path, f)
+            retiring = f"{path}.{claimer()}"
+            try:
+                # Only one of the workers racing to retire it wins it
+                os.rename(path, retiring)
+            except FileNotFoundError:
+                continue
+            lock_path = os.path.join(self.metrics_path, "retired.lock")
+            with open(lock_path, "a") as lockfile, flocked(lockfile.fileno()):
+                retired = self.read_metrics(
+                    os.path.join(self.metrics_path, "retired.json")
+                )
+                snapshot = self.read_metrics(retiring)
+                retired = merge_metrics(retired or {}, snapshot or {})
+                self.write_metrics(
+                    os.path.join(self.metrics_path, "retired.json"), retired
+                )
+            os.remove(retiring)
+
+    def read_metrics(self, path: str):
+        try:
+            with open(path, "r") as jsonfile:
+                return json.load(jsonfile)
+        except FileNotFoundError:
+            return None
+
+    def get_metrics(self):
+        # The counts by status plus the counters and histograms added up for
+        # all the workers, slots only for the workers which saved theirs lately
+        metrics = {"counters": {}, "histograms": {}, "workers": {}}
+        for f in os.listdir(self.metrics_path):
+            if not f.endswith(".json"):
+                continue
+            snapshot = self.read_metrics(os.path.join(self.metrics_path, f))
+            if snapshot is None:
+                continue
+            merge_metrics(metrics, snapshot)
+            if time.time() - snapshot.get("updated", 0) < 3 * METRICS_EVERY:
+                metrics["workers"][f[: -len(".json")]] = snapshot["slots"]
+        metrics["tasks"] = self.get_current_tasks()
+        return metrics
+
+    def get_prometheus_metrics(self):
+        return render_prometheus(self.get_metrics())
+
     def dashboard(
         self, host: str = "localhost", port: int = 3030, return_bottle: bool = False
     ):
+        self.start_logging()
         try:
             import bottle as b
         except:
-            print("Please install `bottle` to use the dashboard")
+            logger.error("Please install `bottle` to use the dashboard")
             return
 
         if not return_bottle:
@@ -329,18 +3492,23 @@ class Kerground:
 
                 has_waitress = True
             except:
-                print("Please install `waitress` for more performance")
+                logger.warning("Please install `waitress` for more performance")
 
         @b.get("/")
         def index():
             return b.template(DASHBOARD_TEMPLATE, tasks=self.get_current_tasks())
 
+        @b.get("/metrics")
+        def metrics():
+            b.response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+            return self.get_prometheus_metrics()
+
         if return_bottle:
             return b
 
         if has_waitress:
-            print("Running with waitress...")
+            logger.info("Running with waitress...")
             serve(b.default_app(), host=host, port=port)
         else:
-            print("Running with bottle development server...")
+            logger.info("Running with bottle development server...")
             b.run(host=host, port=port)
@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import uuid
+import signal
+import multiprocessing
+from contextlib import contextmanager
+
+import pytest
+
+# python -m pytest tests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
+
+from kerground import Kerground  # noqa: E402
+
+
+def add(a, b):
+    return a + b
+
+
+def total(values: list):
+    return sum(values)
+
+
+def draw(seed: int):
+    # Different each time it runs
+    return uuid.uuid4().hex
+
+
+def measure(data: bytes):
+    return [type(data).__name__, len(data)]
+
+
+def boom():
+    raise ValueError("boom")
+
+
+def fail_once(marker: str):
+    # Fails the first time it runs, done when retried
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        raise ValueError("first attempt")
+    return "retried"
+
+
+def die_once(marker: str):
+    # Kills its process the first time it runs
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return "survived"
+
+
+def nap(seconds: float):
+    # When it started and finished
+    start = time.time()
+    time.sleep(seconds)
+    return start, time.time()
+
+
+def make_ker(tasks_path: str, backend: str, **settings):
+    ker = Kerground(
+        tasks_path=tasks_path, backend=backend, log_level="WARNING", **settings
+    )
+    ker.register(ker.MODE.THREAD)(add)
+    ker.register(ker.MODE.THREAD)(total)
+    ker.register(ker.MODE.THREAD)(boom)
+    ker.register(ker.MODE.THREAD, cache=True)(draw)
+    ker.register(ker.MODE.THREAD)(measure)
+    ker.register(
+        ker.MODE.THREAD,
+        max_retries=1,
+        retry_delay=0.5,
+        retry_max_delay=2,
+        retry_jitter=False,
+    )(fail_once)
+    ker.register(ker.MODE.PROCESS, max_retries=1, visibility_timeout=1)(die_once)
+    ker.register(ker.MODE.THREAD, concurrency=1)(nap)
+    return ker
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def ker(tmp_path, backend):
+    return make_ker(str(tmp_path / "tasks"), backend)
+
+
+@contextmanager
+def listening(ker):
+    # A worker listening on the same tasks_path in its own process
+    process = multiprocessing.get_context("fork").Process(target=ker.listen)
+    process.start()
+    try:
+        yield process
+    finally:
+        os.kill(process.pid, signal.SIGINT)
+        process.join(10)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+
+@pytest.fixture
+def worker(ker):
+    with listening(ker) as process:
+        yield process
@@ -0,0 +1,407 @@
+import os
+import time
+import hashlib
+import uuid
+import multiprocessing
+from datetime import datetime
+
+import pytest
+
+from kerground import (
+    LEASE_EXPIRED,
+    Limited,
+    ResultCache,
+    Status,
+    TaskError,
+    parse_cron,
+    cron_next,
+)
+from conftest import make_ker, listening
+
+
+def claim_all(tasks_path: str, backend: str, start, claimed):
+    ker = make_ker(tasks_path, backend)
+    start.wait()
+    ids = []
+    for message, version in ker.backend.iter_pending("add"):
+        job = ker.backend.claim(
+            "add", message["message_id"], ker.worker_id, 60, None, message, version
+        )
+        if job is not None:
+            ids.append(job["message_id"])
+    claimed.put(ids)
+
+
+def claim_pending(ker, lease: float):
+    claimed = []
+    for task in ker.tasks:
+        for message, version in list(ker.backend.iter_pending(task)):
+            job = ker.backend.claim(
+                task,
+                message["message_id"],
+                ker.worker_id,
+                lease,
+                None,
+                message,
+                version,
+            )
+            claimed.append(job["message_id"])
+    return claimed
+
+
+def test_claimed_once_across_processes(ker, backend):
+    ids = [ker.enqueue("add", i, 1) for i in range(100)]
+    ids += ker.enqueue_many("add", [(i, 1) for i in range(100)])
+
+    ctx = multiprocessing.get_context("fork")
+    start, claimed = ctx.Barrier(4), ctx.Queue()
+    processes = [
+        ctx.Process(target=claim_all, args=(ker.tasks_path, backend, start, claimed))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    results = [claimed.get(timeout=30) for _ in processes]
+    for process in processes:
+        process.join()
+
+    # Each job claimed by exactly one of the processes
+    all_claimed = [message_id for ids in results for message_id in ids]
+    assert sorted(all_claimed) == sorted(ids)
+    assert ker.check_statuses(ids) == dict.fromkeys(ids, Status.RUNNING.value)
+    assert claim_pending(ker, 60) == []
+
+
+def test_expired_leases_are_reaped(ker):
+    retried = ker.enqueue("fail_once", "marker")
+    failed = ker.enqueue("add", 1, 2)
+    assert sorted(claim_pending(ker, 0.1)) == sorted([retried, failed])
+
+    # Renewed leases are not reaped
+    time.sleep(0.2)
+    ker.backend.heartbeat([("add", failed, 0.1), ("fail_once", retried, 0.1)])
+    assert ker.backend.reap(lambda task: 0.1) == []
+
+    time.sleep(0.2)
+    reaped = ker.backend.reap(lambda task: 0.1)
+    assert {message_id: status for _, message_id, status, _ in reaped} == {
+        retried: Status.PENDING.value,
+        failed: Status.FAILED.value,
+    }
+    # Reaped by one worker only
+    assert ker.backend.reap(lambda task: 0.1) == []
+
+    # A lease expired counts as a failed attempt
+    assert ker.check_status(retried) == Status.PENDING
+    [job] = ker.backend.iter_jobs("pending", "fail_once")
+    assert job["retries"] == 1
+    assert ker.check_status(failed) == Status.FAILED
+    with pytest.raises(TaskError, match=LEASE_EXPIRED):
+        ker.get_result(failed)
+
+
+def test_retry_delay_backs_off(ker):
+    assert [ker.retry_delay("fail_once", retries) for retries in range(4)] == [
+        0.5,
+        1,
+        2,
+        2,
+    ]
+
+
+@pytest.mark.usefixtures("worker")
+def test_failed_job_is_retried_after_its_delay(ker, tmp_path):
+    start = time.monotonic()
+    message_id = ker.enqueue("fail_once", str(tmp_path / "marker"))
+    assert ker.get_result(message_id, timeout=20) == "retried"
+    assert time.monotonic() - start >= 0.5
+    [job] = [
+        job for job in ker.backend.iter_jobs("done") if job["message_id"] == message_id
+    ]
+    assert job["retries"] == 1
+
+
+def test_unknown_ids(ker):
+    assert ker.check_status("missing") == Status.UNKNOWN
+    assert ker.check_status("../index") == Status.UNKNOWN
+    assert ker.check_statuses(["missing"]) == {"missing": Status.UNKNOWN.value}
+    with pytest.raises(KeyError):
+        ker.get_result("missing", timeout=1)
+
+
+def test_batch_ids(ker):
+    ids = ker.enqueue_many("add", [(1, 2), (3, 4)])
+    batch_id = ids[0].rpartition(".")[0]
+    assert ker.check_statuses(ids) == dict.fromkeys(ids, Status.PENDING.value)
+    # Ids past the end of the batch or of other batches are unknown
+    assert ker.check_status(f"{batch_id}.2") == Status.UNKNOWN
+    assert ker.check_status(f"{uuid.uuid4()}.0") == Status.UNKNOWN
+    with pytest.raises(KeyError):
+        ker.get_result(f"{batch_id}.2", timeout=1)
+    with pytest.raises(TimeoutError):
+        ker.get_result(ids[0], timeout=0.1)
+
+
+@pytest.mark.usefixtures("worker")
+def test_batch_results(ker):
+    ids = ker.enqueue_many("add", [(1, 2), (3, 4)])
+    assert [ker.get_result(message_id, timeout=20) for message_id in ids] == [3, 7]
+    assert ker.check_statuses(ids) == dict.fromkeys(ids, Status.DONE.value)
+
+
+@pytest.mark.usefixtures("worker")
+def test_job_of_a_dead_process_is_retried(ker, tmp_path):
+    message_id = ker.enqueue("die_once", str(tmp_path / "marker"))
+    assert ker.get_result(message_id, timeout=20) == "survived"
+    [job] = [
+        job for job in ker.backend.iter_jobs("done") if job["message_id"] == message_id
+    ]
+    assert job["retries"] == 1
+    # The slot of the dead process is free again
+    assert ker.get_result(ker.enqueue("add", 1, 2), timeout=20) == 3
+
+
+@pytest.mark.parametrize(
+    "schedule, after, expected",
+    [
+        (
+            "*/15 9-17 * * 1-5",
+            datetime(2026, 10, 16, 17, 50),
+            datetime(2026, 10, 19, 9),
+        ),
+        # Either the 13th or a Friday when both days are restricted
+        ("0 0 13 * 5", datetime(2026, 10, 1), datetime(2026, 10, 2)),
+        ("0 0 13 * 5", datetime(2026, 10, 10), datetime(2026, 10, 13)),
+        # Sunday is both 0 and 7
+        ("0 0 * * 7", datetime(2026, 10, 1), datetime(2026, 10, 4)),
+        ("0 0 * * 0", datetime(2026, 10, 1), datetime(2026, 10, 4)),
+        # Months without the day are skipped, over the end of the year too
+        ("30 23 31 * *", datetime(2026, 11, 1), datetime(2026, 12, 31, 23, 30)),
+        ("0 12 1 1 *", datetime(2026, 10, 18), datetime(2027, 1, 1, 12)),
+        ("0 0 29 2 *", datetime(2026, 3, 1), datetime(2028, 2, 29)),
+    ],
+)
+def test_cron_next(schedule, after, expected):
+    assert cron_next(parse_cron(schedule), after.timestamp()) == expected.timestamp()
+
+
+@pytest.mark.parametrize(
+    "schedule",
+    [
+        "* * * *",
+        "60 * * * *",
+        "* 24 * * *",
+        "* * 0 * *",
+        "* * * 13 *",
+        "* * * * 8",
+        "*/0 * * * *",
+        "5-1 * * * *",
+        "a * * * *",
+    ],
+)
+def test_invalid_schedules(schedule):
+    with pytest.raises(AssertionError):
+        parse_cron(schedule)
+
+
+def test_schedule_that_never_runs(ker):
+    with pytest.raises(ValueError, match="never runs"):
+        ker.register(ker.MODE.THREAD, schedule="0 0 31 2 *")(lambda: None)
+
+
+def test_token_bucket(ker):
+    # 2 jobs a second, both can start at once then one every half second
+    limit = {"concurrency": None, "rate": (2, 1)}
+    bucket = ker.backend.take(0, None, limit)
+    assert bucket[0] == 1
+    bucket = ker.backend.take(0, bucket, limit)
+    with pytest.raises(Limited) as limited:
+        ker.backend.take(0, bucket, limit)
+    assert 0 < limited.value.wait <= 0.5
+    tokens, updated = bucket
+    assert ker.backend.take(0, (tokens, updated - 0.5), limit)[0] < 0.1
+    # Never more than the whole rate after a quiet period
+    assert ker.backend.take(0, (0, updated - 60), limit)[0] == 1
+
+
+def test_concurrency_holds_across_workers(ker, backend):
+    other = make_ker(ker.tasks_path, backend)
+    limit = ker.limit_for("nap")
+    first, second = ker.enqueue("nap", 0), ker.enqueue("nap", 0)
+    job = ker.backend.claim("nap", first, ker.worker_id, 60, limit)
+    assert job["message_id"] == first
+    with pytest.raises(Limited) as limited:
+        other.backend.claim("nap", second, other.worker_id, 60, limit)
+    # Until one of the jobs running finishes
+    assert limited.value.wait is None
+    assert ker.backend.move("nap", first, "running", "done")
+    job = other.backend.claim("nap", second, other.worker_id, 60, limit)
+    assert job["message_id"] == second
+
+
+def test_limited_jobs_run_once_the_last_one_finished(tmp_path, backend):
+    # Blocked for 5s at most, the finished job unblocks the task long before
+    ker = make_ker(str(tmp_path / "tasks"), backend, pool=5)
+    ids = [ker.enqueue("nap", 0.2) for _ in range(4)]
+    with listening(ker):
+        spans = sorted(ker.get_result(message_id, timeout=20) for message_id in ids)
+    for (_, end), (start, _) in zip(spans, spans[1:]):
+        assert end <= start < end + 1
+
+
+@pytest.mark.usefixtures("worker")
+def test_chain_passes_results(ker):
+    ids = ker.chain(ker.step("add", 1, 2), ker.step("add", 3), ker.step("add", 4))
+    assert ker.get_result(ids[2], timeout=20) == 10
+    assert [ker.get_result(message_id) for message_id in ids] == [3, 6, 10]
+
+
+@pytest.mark.usefixtures("worker")
+def test_group_and_chord_gather_results(ker):
+    ids = ker.group(ker.step("add", 1, 2), ker.step("add", 3, 4))
+    assert [ker.get_result(message_id, timeout=20) for message_id in ids] == [3, 7]
+    steps, callback = ker.chord(
+        [ker.step("add", 1, 2), ker.step("add", 3, 4)], ker.step("total")
+    )
+    assert ker.get_result(callback, timeout=20) == 10
+    ids = ker.chain([ker.step("add", 1, 1), ker.step("add", 2, 2)], ker.step("total"))
+    assert ker.get_result(ids[1], timeout=20) == 6
+
+
+@pytest.mark.usefixtures("worker")
+def test_steps_after_a_failed_one_fail_without_running(ker):
+    first, second, third = ker.chain("boom", ker.step("add", 1), ker.step("add", 2))
+    with pytest.raises(TaskError, match=f"job {first} before it failed"):
+        ker.get_result(second, timeout=20)
+    with pytest.raises(TaskError, match=f"job {second} before it failed"):
+        ker.get_result(third, timeout=20)
+    assert ker.check_statuses([first, second, third]) == dict.fromkeys(
+        [first, second, third], Status.FAILED.value
+    )
+
+
+def test_orphaned_waiting_steps_are_started(ker):
+    first, second = ker.chain(ker.step("add", 1, 2), ker.step("add", 3))
+    assert ker.check_status(second) == Status.WAITING.value
+    # As left by a worker which stopped before starting the step after it
+    ker.workflows.unlink(first)
+    with listening(ker):
+        assert ker.get_result(second, timeout=20) == 6
+
+
+def finish(ker, task: str, message_id: str, status: str):
+    assert ker.backend.claim(task, message_id, ker.worker_id, 60, None)
+    assert ker.backend.move(task, message_id, "running", status)
+
+
+def test_duplicates_are_enqueued_once(ker):
+    first = ker.enqueue("add", 1, 2, idempotency_key="request-1")
+    assert ker.enqueue("add", 1, 2, idempotency_key="request-1") == first
+    assert ker.enqueue("add", 1, 2, idempotency_key="request-2") != first
+    # Keys are per task
+    assert ker.enqueue("total", [1, 2], idempotency_key="request-1") != first
+    # Made of the args with True
+    first = ker.enqueue("add", 5, 6, idempotency_key=True)
+    assert ker.enqueue("add", 5, 6, idempotency_key=True) == first
+    assert ker.enqueue("add", 6, 5, idempotency_key=True) != first
+    assert len(ker.backend.jobs("pending")) == 5
+
+
+def test_done_duplicates_expire(ker, backend):
+    first = ker.enqueue("add", 1, 2, idempotency_key="request")
+    finish(ker, "add", first, "done")
+    assert ker.enqueue("add", 1, 2, idempotency_key="request") == first
+    # Past the ttl the key is free again, whether purged or not
+    expired = make_ker(ker.tasks_path, backend, idempotency_ttl=0)
+    second = expired.enqueue("add", 1, 2, idempotency_key="request")
+    assert second != first
+    # Waiting jobs stay duplicates however old
+    assert expired.enqueue("add", 1, 2, idempotency_key="request") == second
+    finish(ker, "add", second, "done")
+    expired.backend.purge_keys(0, expired.is_duplicate)
+    assert ker.enqueue("add", 1, 2, idempotency_key="request") not in [first, second]
+
+
+def test_failed_duplicates_can_be_enqueued_again(ker):
+    first = ker.enqueue("add", 1, 2, idempotency_key="request")
+    finish(ker, "add", first, "failed")
+    second = ker.enqueue("add", 1, 2, idempotency_key="request")
+    assert second != first
+    assert ker.enqueue("add", 1, 2, idempotency_key="request") == second
+
+
+@pytest.mark.usefixtures("worker")
+def test_cached_results(ker):
+    drawn = ker.get_result(ker.enqueue("draw", 1), timeout=20)
+    # Done with the result saved by the first one, not run again
+    message_id = ker.enqueue("draw", 1)
+    assert ker.get_result(message_id, timeout=20) == drawn
+    assert ker.check_status(message_id) == Status.DONE.value
+    assert ker.get_result(ker.enqueue("draw", 2), timeout=20) != drawn
+
+
+def test_cached_results_expire(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key = cache.key([1], {})
+    cache.put("draw", key, '"drawn"')
+    assert cache.get("draw", key, ttl=60) == '"drawn"'
+    time.sleep(0.01)
+    assert cache.get("draw", key, ttl=0) is None
+    assert cache.get("draw", key) is None
+    cache.put("draw", key, '"drawn"')
+    cache.purge({"draw": 60})
+    assert cache.get("draw", key) == '"drawn"'
+    time.sleep(0.01)
+    cache.purge({"draw": 0})
+    assert cache.get("draw", key) is None
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    keys = [cache.key([i], {}) for i in range(11)]
+    for i, key in enumerate(keys[:10]):
+        cache.put("draw", key, str(i), max_entries=10)
+        os.utime(os.path.join(cache.path, "draw", key), (i, i))
+    # A hit makes it the most recently used
+    assert cache.get("draw", keys[0]) == "0"
+    cache.put("draw", keys[10], "10", max_entries=10)
+    # Down to a tenth under the limit, the oldest first
+    kept = [key for key in keys if cache.get("draw", key) is not None]
+    assert kept == [keys[0], *keys[3:]]
+
+
+def blob_refs(ker, digest: str):
+    with ker.blobs.refs(digest, create=False) as fd:
+        return ker.blobs.read_refs(fd)
+
+
+def test_blobs_are_removed_with_their_last_job(tmp_path, backend):
+    ker = make_ker(str(tmp_path / "tasks"), backend, blob_threshold=16)
+    data = b"x" * 32
+    first = ker.enqueue("measure", data, idempotency_key="blob")
+    [job] = ker.backend.jobs("pending")
+    assert job["args"] == [
+        {ker.blobs.MARKER: hashlib.sha256(data).hexdigest(), "size": 32}
+    ]
+    [digest] = ker.blobs.digests(job)
+    assert blob_refs(ker, digest) == 1
+    # A duplicate gives its reference back, the same bytes share the blob
+    assert ker.enqueue("measure", data, idempotency_key="blob") == first
+    assert blob_refs(ker, digest) == 1
+    second = ker.enqueue("measure", bytearray(data))
+    assert blob_refs(ker, digest) == 2
+    assert len(os.listdir(ker.blobs.path)) == 2
+
+    job = ker.backend.claim("measure", first, ker.worker_id, 60, None)
+    ker.succeeded(job, time.perf_counter(), None)
+    assert blob_refs(ker, digest) == 1
+    job = ker.backend.claim("measure", second, ker.worker_id, 60, None)
+    ker.failed(job, time.perf_counter(), ValueError("boom"))
+    assert os.listdir(ker.blobs.path) == []
+
+
+def test_tasks_get_a_view_of_the_blob(tmp_path, backend):
+    ker = make_ker(str(tmp_path / "tasks"), backend, blob_threshold=16)
+    message_id = ker.enqueue("measure", b"x" * 32)
+    with listening(ker):
+        assert ker.get_result(message_id, timeout=20) == ["memoryview", 32]